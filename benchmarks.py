@@ -0,0 +1,238 @@
+""" benchmarks for snake.  like tests.py, these start a headless vim and run a
+snake script inside of it, but the script times itself and sends the timings
+back.  run with:
+
+    python benchmarks.py
+
+results are microseconds per operation, keyed like "get_word/lines=1000".  they
+can be written out as json with --output, and compared against a baseline from
+an earlier run with --baseline.  any benchmark that got slower than the baseline
+by more than --threshold (a fraction, 0.25 by default) is reported as a
+regression, and we exit with a nonzero status, so this can gate changes:
+
+    python benchmarks.py --output baseline.json
+    ... make changes ...
+    python benchmarks.py --baseline baseline.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from tests import run_vim
+
+
+KEY_PRESSES = 2000
+BUFFER_SIZES = (10, 1000, 100000, 1000000)
+BUFFER_COUNTS = (1, 100, 1000, 5000)
+QUICK_BUFFER_SIZES = (10, 1000)
+QUICK_BUFFER_COUNTS = (1, 100)
+DEFAULT_THRESHOLD = 0.25
+
+# each operation is repeated until it has run for this long, or this many
+# times, whichever comes first, and the average is reported
+MIN_TIME = 0.2
+MAX_REPS = 1000
+
+
+TIMER = r"""
+import time
+
+def bench(fn):
+    reps = 0
+    start = time.time()
+    while True:
+        fn()
+        reps += 1
+        elapsed = time.time() - start
+        if elapsed >= {min_time} or reps >= {max_reps}:
+            break
+    return elapsed * 1000000.0 / reps
+"""
+
+
+def _timed_script(script, **kwargs):
+    """ puts our timing helper in front of a benchmark script """
+    timer = TIMER.format(min_time=MIN_TIME, max_reps=MAX_REPS)
+    return timer + script.format(**kwargs)
+
+
+def sample_buffer(num_lines):
+    """ a buffer of num_lines words, with a line to search for at the end """
+    lines = ["line %d has some words in it" % i for i in range(num_lines - 1)]
+    lines.append("the needle is here")
+    return "\n".join(lines) + "\n"
+
+
+def bench_buffer_size(num_lines):
+    """ measures the helpers that work on the current buffer, for a buffer of
+    num_lines.  returns microseconds per call, by helper """
+    script = r"""
+results = {{}}
+buf = get_current_buffer()
+middle = {middle}
+
+# on the word "some"
+set_cursor_position((middle, {col}))
+results["get_word"] = bench(get_word)
+
+words = ["some", "other"]
+def replace():
+    words.reverse()
+    replace_word(words[0])
+results["replace_word"] = bench(replace)
+
+set_cursor_position((1, 1))
+results["search"] = bench(lambda: search("needle", move=False))
+
+set_cursor_position((middle, 1))
+keys("V9j\<esc>")
+results["get_visual_selection"] = bench(get_visual_selection)
+
+contents = [get_current_buffer_contents()]
+contents.append(contents[0].replace("line %d " % middle, "changed ", 1))
+def set_contents(diff):
+    contents.reverse()
+    set_buffer_contents(buf, contents[0], diff=diff)
+results["set_buffer_contents"] = bench(lambda: set_contents(False))
+results["set_buffer_contents(diff)"] = bench(lambda: set_contents(True))
+
+send(results)
+"""
+    middle = max(1, num_lines // 2)
+    col = len("line %d has " % (middle - 1)) + 1
+    script = _timed_script(script, middle=middle, col=col)
+    _, output = run_vim(script, sample_buffer(num_lines), commands=["qa!"])
+    return output
+
+
+def bench_buffer_count(num_buffers):
+    """ measures listing buffers, with num_buffers of them open.  returns
+    microseconds per call """
+    script = r"""
+with batch():
+    for i in range({count}):
+        command("badd snake_bench_%d" % i)
+send({{"get_buffers": bench(get_buffers)}})
+"""
+    script = _timed_script(script, count=num_buffers - 1)
+    _, output = run_vim(script, commands=["qa!"])
+    return output
+
+
+def bench_key_dispatch(presses=KEY_PRESSES):
+    """ measures the overhead of a key press that is mapped to a python
+    function, for each of the ways key_map can dispatch to python.  a plain vim
+    mapping is timed as a baseline.  returns microseconds per key press """
+    script = r"""
+import time
+
+def noop():
+    pass
+
+def time_keys(presses):
+    start = time.time()
+    keys("a" * presses)
+    return (time.time() - start) * 1000000.0 / presses
+
+# something is usually listening for command-line mode, which is part of the
+# cost of dispatching through it
+command("autocmd CmdlineEnter,CmdlineLeave * let g:_bench_cmdline = 1")
+
+results = {{}}
+key_map("a", "<Nop>")
+results["vim"] = time_keys({presses})
+
+modes = [DISPATCH_CMDLINE]
+if int(vim.eval("has('patch-8.2.1978')")):
+    modes.append(DISPATCH_CMD)
+
+for mode in modes:
+    set_dispatch_mode(mode)
+    key_map("a", noop)
+    results[mode] = time_keys({presses})
+
+send(results)
+""".format(presses=presses)
+    _, output = run_vim(script, commands=["qa!"])
+    return output
+
+
+def run_all(buffer_sizes=BUFFER_SIZES, buffer_counts=BUFFER_COUNTS,
+        verbose=False):
+    """ runs every benchmark, and returns the results as one flat dictionary
+    of microseconds per operation """
+    results = {}
+
+    def collect(label, timings):
+        for name, value in timings.items():
+            key = "%s/%s" % (name, label)
+            results[key] = value
+            if verbose:
+                print("%-50s %12.1f us" % (key, value))
+
+    for size in buffer_sizes:
+        collect("lines=%d" % size, bench_buffer_size(size))
+    for count in buffer_counts:
+        collect("buffers=%d" % count, bench_buffer_count(count))
+    # per key press, by how the key was dispatched
+    for mode, value in bench_key_dispatch().items():
+        collect(mode, {"key_dispatch": value})
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ compares results against a baseline of the same shape.  returns the
+    (name, baseline, result, change) of every benchmark that slowed down by
+    more than threshold, where change is a fraction """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        old, new = baseline[name], results[name]
+        if old <= 0:
+            continue
+        change = (new - old) / old
+        if change > threshold:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for snake")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against the results in "
+            "this json file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+            help="how much slower than the baseline, as a fraction, counts as "
+            "a regression")
+    parser.add_argument("--quick", action="store_true", help="only run the "
+            "smaller buffer sizes and counts")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        sizes, counts = QUICK_BUFFER_SIZES, QUICK_BUFFER_COUNTS
+    else:
+        sizes, counts = BUFFER_SIZES, BUFFER_COUNTS
+    results = run_all(sizes, counts, verbose=True)
+
+    if args.output:
+        with open(args.output, "w") as h:
+            json.dump({"unit": "us", "results": results}, h, indent=2,
+                    sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as h:
+            baseline = json.load(h)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new, change in regressions:
+            print("REGRESSION %s: %.1f us -> %.1f us (%+.0f%%)" % (name, old,
+                new, change * 100))
+        if regressions:
+            return 1
+        print("no regressions over %.0f%%" % (args.threshold * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,40 @@
 " if there is no pyeval, we use this polyfill taken from
 " https://github.com/google/vim-maktaba/issues/70#issue-35289378
+" json is imported once, up front, because this runs on every abbreviation
+" expansion
 if exists("*pyeval")
 else
     if has("python")
+        python import json
         function! Pyeval(expr)
-            python import json
             python vim.command('return '+json.dumps(eval(vim.eval('a:expr'))))
         endfunction
     else
+        python3 import json
         function! Pyeval(expr)
-            python3 import json
             python3 vim.command('return '+json.dumps(eval(vim.eval('a:expr'))))
         endfunction
     endif
 endif
+
+" snake's timers all call this, and it hands the timer back to snake on the
+" python side.  python_cmd is bound with function() when the timer is started
+function! SnakeTimer(python_cmd, timer)
+    exec a:python_cmd . " snake._on_timer(" . a:timer . ")"
+endfunction
+
+" snake's autocommands call this, so that everything vim knows about the event
+" reaches the python handler in the same call.  strings are quoted for python by
+" hand, since they can be any file name
+function! s:PyString(s)
+    let s = escape(a:s, "\\'")
+    let s = substitute(s, "\n", '\\n', 'g')
+    return "'" . substitute(s, "\r", '\\r', 'g') . "'"
+endfunction
+
+function! SnakeAutocmd(python_cmd, handle, event)
+    let buf = expand('<abuf>') ==# '' ? bufnr('%') : str2nr(expand('<abuf>'))
+    exec a:python_cmd . printf(" snake.dispatch_autocmd('%s', '%s', %d, %d, %s, %s)",
+        \ a:handle, a:event, buf, getbufvar(buf, 'changedtick', 0),
+        \ s:PyString(expand('<afile>')), s:PyString(expand('<amatch>')))
+endfunction
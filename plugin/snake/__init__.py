@@ -3,13 +3,18 @@ from __future__ import absolute_import, print_function, unicode_literals
 import vim
 from contextlib import contextmanager 
 from functools import wraps, partial
+from collections import OrderedDict, deque
 import os
 import sys
 from os.path import expanduser, exists, abspath, join, dirname
 import time
-import inspect
 import re
 
+# modules that only some features need, like difflib for diffed buffer writes,
+# are imported where they're used, to keep starting vim fast
+
+_import_start = time.time()
+
 __version__ = "0.15.5"
 
 
@@ -30,16 +35,363 @@ PYTHON_CMD = "python3" if IS_PY3 else "python"
 _LEADER_REGEX = re.compile(r"\\<leader>", re.I)
 _BUFFER_LIST_REGEX = re.compile(r"^\s*(\d+)\s+(.+?)\s+\"(.+?)\"", re.M)
 
+# maps the handles that vim uses to call python functions to their
+# _Registration.  see register_fn()
 _mapped_functions = {
 }
 
-# if pyeval doesn't exist, we use our own, defined in prelude.vim.  pyeval
-# doesn't exist in vim 7.3
-PYEVAL = "pyeval"
-if not bool(int(vim.eval("exists('*pyeval')"))):
-    PYEVAL = "Pyeval"
+# commands queued up by an open batch(), and how deeply nested we are in
+# batches.  see batch() below
+_batched_commands = []
+_batch_depth = 0
+
+# with SNAKE_PROFILE_STARTUP=1 in the environment, how long each phase of
+# starting up takes, and each registration made along the way, is shown in
+# :messages.  a list of (what, milliseconds), or None when we're not profiling
+_startup_profile = None
+if os.environ.get("SNAKE_PROFILE_STARTUP", "0") not in ("", "0"):
+    _startup_profile = []
+
+@contextmanager
+def _startup_phase(name):
+    """ times the with-block as part of starting up, if we're profiling it """
+    if _startup_profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _startup_profile.append((name, (time.time() - start) * 1000))
+
+def _startup_timed(label):
+    """ a decorator for registration functions, like key_map, that times each
+    call while we're profiling startup.  label is called with the same
+    arguments and names the call, or returns None if there's nothing to time,
+    like when key_map is being used as a decorator """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            name = None
+            if _startup_profile is not None:
+                name = label(*args, **kwargs)
+            if name is None:
+                return fn(*args, **kwargs)
+            with _startup_phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def startup_profile():
+    """ returns (what, milliseconds) for each phase of starting up and each
+    registration made while loading, if vim was started with
+    SNAKE_PROFILE_STARTUP=1.  otherwise, an empty list """
+    return list(_startup_results)
+
+def _finish_startup_profile():
+    """ stops profiling startup, and shows the results in :messages """
+    global _startup_profile, _startup_results
+    if _startup_profile is None:
+        return
+    _startup_results, _startup_profile = _startup_profile, None
+    with batch():
+        for name, ms in _startup_results:
+            command("echom '%s'" % escape_string_sq("snake startup: %8.2fms  %s"
+                % (ms, name)))
+
+_startup_results = []
+
+
+# pyeval doesn't exist in vim 7.3, so we use our own, defined in prelude.vim.
+# we find out which one we have the first time we need it
+def _get_pyeval():
+    return "pyeval" if _has_function("pyeval") else "Pyeval"
+
+def _get_vim_version():
+    """ vim's v:version, like 704.  fetched the first time it's needed """
+    global _vim_version
+    if _vim_version is None:
+        _vim_version = int(_eval("v:version"))
+    return _vim_version
+
+_vim_version = None
+
+def _vim_eval(expr):
+    """ the one place we call vim.eval, so calls into vim can be measured,
+    counted and recorded """
+    if _profiler is None and not _round_trip_counters and _recorder is None:
+        return vim.eval(expr)
+    return _measured_call(vim.eval, expr, "eval")
+
+def _vim_command(cmd):
+    """ the one place we call vim.command.  see _vim_eval """
+    if _command_log is not None:
+        _command_log.append(cmd)
+    if _skip_commands:
+        return None
+    if _profiler is None and not _round_trip_counters and _recorder is None:
+        return vim.command(cmd)
+    return _measured_call(vim.command, cmd, "command")
+
+def _set_lines(b, start, end, lines):
+    """ the one place we write to a buffer object directly, as b[start:end] =
+    lines.  that isn't a vim.command, so the flight recorder logs the
+    setbufline() and friends that would do the same, to keep recordings
+    replayable """
+    if _recorder is None:
+        b[start:end] = lines
+        return
+
+    name = _round_trip_caller()
+    begin = time.time()
+    try:
+        b[start:end] = lines
+    finally:
+        _recorder.append(RecordedCall(begin, time.time() - begin, "buffer",
+            _set_lines_command(b.number, start, end, lines), name,
+            _call_site()))
+
+@contextmanager
+def _logging_commands():
+    """ collects every command sent to vim inside the with-block, in the list
+    it yields.  plugin_loader uses this to snapshot what ~/.vimrc.py does """
+    global _command_log
+    old_log, _command_log = _command_log, []
+    try:
+        yield _command_log
+    finally:
+        _command_log = old_log
+
+@contextmanager
+def _skipping_commands():
+    """ commands sent inside the with-block are dropped instead of run, for
+    when vim is already in the state they would put it in, like after a
+    vimrc.py snapshot was replayed.  evals still happen """
+    global _skip_commands
+    _flush_batch()
+    old_skip, _skip_commands = _skip_commands, True
+    try:
+        yield
+    finally:
+        _flush_batch()
+        _skip_commands = old_skip
 
-VERSION = int(int(vim.eval("v:version")))
+_command_log = None
+_skip_commands = False
+
+def _measured_call(call, arg, kind):
+    name = None
+    if _round_trip_counters or _recorder is not None:
+        name = _round_trip_caller()
+    for counter in _round_trip_counters:
+        counter.add(name, kind)
+
+    start = time.time()
+    try:
+        return call(arg)
+    finally:
+        elapsed = time.time() - start
+        if _profiler is not None:
+            _profiler.vim_time += elapsed
+        if _recorder is not None:
+            _recorder.append(RecordedCall(start, elapsed, kind, arg, name,
+                _call_site()))
+
+def _round_trip_caller():
+    """ the name of the snake function that a call into vim is for.  that's
+    the outermost public snake function in the run of snake frames leading
+    here, so a call made by get_word's helpers counts against get_word.
+    contextlib's frames don't break the run, so context managers like
+    preserve_cursor() count against whatever used them """
+    name = outer = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        frame_globals = frame.f_globals
+        if frame_globals is _module_globals:
+            outer = frame.f_code.co_name
+            if not outer.startswith("_"):
+                name = outer
+            elif outer.startswith("__") and "self" in frame.f_locals:
+                # __enter__ and __exit__ of things like batch()
+                name = type(frame.f_locals["self"]).__name__
+        elif frame_globals.get("__name__") != "contextlib":
+            break
+        frame = frame.f_back
+    return name or outer or "<unknown>"
+
+def _call_site():
+    """ "file:line" of the code outside of snake that led to this call into
+    vim """
+    frame = sys._getframe(3)
+    while frame is not None:
+        frame_globals = frame.f_globals
+        if frame_globals is not _module_globals and \
+                frame_globals.get("__name__") != "contextlib":
+            return "%s:%d" % (frame.f_code.co_filename, frame.f_lineno)
+        frame = frame.f_back
+    return "<unknown>"
+
+class RoundTrips(object):
+    """ counts of calls into vim, collected by count_round_trips() """
+
+    __slots__ = ("evals", "commands", "by_function")
+
+    def __init__(self):
+        self.evals = 0
+        self.commands = 0
+        self.by_function = {}
+
+    @property
+    def total(self):
+        return self.evals + self.commands
+
+    def add(self, name, kind):
+        if kind == "eval":
+            self.evals += 1
+        else:
+            self.commands += 1
+        self.by_function[name] = self.by_function.get(name, 0) + 1
+
+    def __repr__(self):
+        by_function = ", ".join("%s: %d" % item for item in
+                sorted(self.by_function.items(), key=lambda i: (-i[1], i[0])))
+        return "<RoundTrips %d (%d evals, %d commands) %s>" % (self.total,
+                self.evals, self.commands, by_function)
+
+@contextmanager
+def count_round_trips():
+    """ counts the calls into vim, vim.eval and vim.command, made inside the
+    with-block, and which snake function made them:
+
+        with count_round_trips() as trips:
+            get_word()
+        print(trips.total, trips.by_function)
+    """
+    trips = RoundTrips()
+    _round_trip_counters.append(trips)
+    try:
+        yield trips
+    finally:
+        _round_trip_counters.remove(trips)
+
+@contextmanager
+def expect_round_trips(max):
+    """ like count_round_trips(), but raises an AssertionError if the
+    with-block made more than max calls into vim.  for keeping an eye on
+    performance in tests """
+    with count_round_trips() as trips:
+        yield trips
+    if trips.total > max:
+        raise AssertionError("expected at most %d round trips to vim, got %r"
+                % (max, trips))
+
+_round_trip_counters = []
+_module_globals = globals()
+
+
+# how many calls into vim the flight recorder keeps, by default
+FLIGHT_RECORDER_SIZE = 10000
+
+class RecordedCall(object):
+    """ one call into vim, as seen by the flight recorder.  kind is "eval",
+    "command" or "buffer", for a write into a buffer object, whose text is the
+    vimscript that does the same.  start is a unix timestamp and duration is in
+    seconds """
+
+    __slots__ = ("start", "duration", "kind", "text", "function", "call_site")
+
+    def __init__(self, start, duration, kind, text, function, call_site):
+        self.start = start
+        self.duration = duration
+        self.kind = kind
+        self.text = text
+        self.function = function
+        self.call_site = call_site
+
+    def __repr__(self):
+        return "<RecordedCall %s %r %.3fms from %s at %s>" % (self.kind,
+                self.text, self.duration * 1000, self.function,
+                self.call_site)
+
+def start_recording(size=FLIGHT_RECORDER_SIZE):
+    """ starts logging every vim.eval and vim.command snake makes, and every
+    write straight into a buffer object, with when it happened, how long it
+    took and where it came from.  only the last size calls are kept.  starting
+    again throws away the old recording """
+    global _recorder
+    _recorder = deque(maxlen=size)
+
+def stop_recording():
+    """ stops recording and returns what was recorded, oldest first """
+    global _recorder
+    recording, _recorder = _recorder, None
+    return list(recording or [])
+
+def get_recording():
+    """ returns what has been recorded so far, oldest first """
+    return list(_recorder or [])
+
+def _vim_string(s):
+    """ s as a single quoted vimscript string expression.  newlines can't be
+    inside of single quotes, so they're joined on with double quoted ones """
+    specials = {"\n": '"\\n"', "\r": '"\\r"'}
+    parts = [specials.get(part) or "'%s'" % escape_string_sq(part) for part in
+            re.split(r"(\r|\n)", s) if part]
+    return " . ".join(parts) or "''"
+
+def _set_lines_command(buf, start, end, lines):
+    """ vimscript that does what b[start:end] = lines does, for buffer number
+    buf """
+    lines = [_vim_string(line) for line in lines]
+    kept = min(end - start, len(lines))
+    calls = []
+    if kept:
+        calls.append("setbufline(%d, %d, [%s])" % (buf, start + 1,
+            ", ".join(lines[:kept])))
+    if len(lines) > kept:
+        calls.append("appendbufline(%d, %d, [%s])" % (buf, start + kept,
+            ", ".join(lines[kept:])))
+    elif end > start + kept:
+        calls.append("deletebufline(%d, %d, %d)" % (buf, start + kept + 1,
+            end))
+    return " | ".join("call " + call for call in calls)
+
+def export_recording(path, recording=None):
+    """ writes the recording, or what's been recorded so far, to path as a vim
+    script that makes the same calls.  it can be replayed in a headless vim,
+    to reproduce or benchmark what snake did:
+
+        vim -N -u NONE -i NONE -es -S recording.vim -c 'qa!'
+
+    evals are replayed by assigning them to a variable, so their cost is the
+    same.  writes to buffers are replayed with setbufline() and friends, on the
+    same buffer numbers.  the script reports how long it took when it's done
+    """
+    if recording is None:
+        recording = get_recording()
+    first = recording[0].start if recording else 0
+    lines = [
+        '" snake flight recording: %d calls into vim' % len(recording),
+        '" each call is preceded by: ms since the first call, how long it',
+        '" took in ms, the snake function and the call site',
+        "let s:snake_replay_start = reltime()",
+    ]
+    for call in recording:
+        lines.append('" %.3f %.3f %s %s' % ((call.start - first) * 1000,
+            call.duration * 1000, call.function, call.call_site))
+        if call.kind == "eval":
+            lines.append("silent! let g:_snake_replay = eval(%s)" %
+                    _vim_string(call.text))
+        else:
+            lines.append("silent! execute %s" % _vim_string(call.text))
+    lines.append("echo 'replayed %d calls in' "
+            "reltimestr(reltime(s:snake_replay_start)) 'seconds'" %
+            len(recording))
+
+    with open(path, "w") as h:
+        h.write("\n".join(lines) + "\n")
+
+_recorder = None
 
 
 def _get_buffer(i):
@@ -47,72 +399,458 @@ def _get_buffer(i):
     # for some reason, version 7.3 indexes their vim.buffers at 0 for buffer 1.
     # version 704 has buffer 1 at index 1, even though len(vim.buffers) == 1.
     # its weird.
-    if VERSION < 704:
+    if _get_vim_version() < 704:
         i -= 1
+    # reading or writing a buffer object directly needs to see the effects of
+    # any commands we've batched up
+    _flush_batch()
     return vim.buffers[i]
 
+def _current_buffer():
+    """ the current buffer object, with any batched commands flushed """
+    _flush_batch()
+    return vim.current.buffer
+
+def _eval(expr):
+    """ evaluates a vim expression.  all reads go through here so that any
+    pending batched commands are flushed first, and the read sees up-to-date
+    state """
+    _flush_batch()
+    return _vim_eval(expr)
+
+def _flush_batch():
+    """ sends all of our queued commands to vim in one crossing """
+    global _batched_commands, _batch_counter
+    cmds, _batched_commands = _batched_commands, []
+    if not cmds:
+        return
+
+    if len(cmds) == 1:
+        _vim_command(cmds[0])
+    else:
+        # a vim list of the commands, executed one at a time on the vim side,
+        # so they only cost us a single call into vim.  a command that fails
+        # doesn't stop the ones after it.  the first error is raised once
+        # they've all run, so it reaches python like it would have without a
+        # batch.  a batched command can fire an autocommand that flushes a
+        # batch of its own, so each flush has its own variables
+        _batch_counter += 1
+        var = "g:_snake_batch_%d" % _batch_counter
+        errors = var + "_errors"
+        cmd_list = ", ".join(["'%s'" % escape_string_sq(cmd) for cmd in cmds])
+        _vim_command("let {errors} = [] | for {var} in [{cmds}] | try | \
+execute {var} | catch | call add({errors}, v:exception) | endtry | endfor | \
+unlet! {var} | if !empty({errors}) | let v:errmsg = {errors}[0] | \
+unlet {errors} | echoerr v:errmsg | endif | unlet! {errors}".format(var=var,
+            errors=errors, cmds=cmd_list))
+
+_batch_counter = 0
+
+
+class batch(object):
+    """ a context manager (or decorator) that queues up every command issued
+    inside of it, and sends them to vim all at once when the outermost batch
+    exits.  reads, like get() or get_option(), flush the queue early so that
+    they always see the effects of the commands that came before them:
+
+        with batch():
+            set_option("expandtab")
+            let("something", "1")
+
+        @batch()
+        def setup():
+            ...
+    """
+
+    def __enter__(self):
+        global _batch_depth
+        _batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global _batch_depth
+        _batch_depth -= 1
+        # we flush even if an exception happened, because without a batch,
+        # those commands would have already run
+        if _batch_depth == 0:
+            _flush_batch()
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+        return wrapper
+
+
 def command(cmd, capture=False):
     """ wraps vim.capture to execute a vim command.  if capture is true, we'll
-    return the output of that command """
+    return the output of that command.  inside of a batch(), commands are
+    queued instead of being run immediately """
+    # newlines can't live inside of our batched vim list, so commands that
+    # contain them just run on their own, in order
+    if _batch_depth and not capture and "\n" not in cmd and "\r" not in cmd:
+        _batched_commands.append(cmd)
+        return None
+
+    _flush_batch()
     if capture:
-        with preserve_registers("a"):
-            vim.command("redir @a")
-            vim.command(cmd)
-            vim.command("redir END")
-            out = get_register("a")
+        out = _capture_output(cmd)
     else:
         out = None
-        vim.command(cmd)
+        _vim_command(cmd)
     return out
 
+def _has_function(name):
+    """ whether vim has the builtin function name, like execute(), which was
+    added in 7.4.2008.  we only check the first time we need to know """
+    try:
+        return _vim_functions[name]
+    except KeyError:
+        exists = bool(int(_eval("exists('*%s')" % name)))
+        _vim_functions[name] = exists
+        return exists
+
+_vim_functions = {}
+_capture_counter = 0
 
-def dispatch_mapped_function(key):
+def _has_feature(name):
+    """ like vim's has(), but we only ask vim the first time """
+    try:
+        return _vim_features[name]
+    except KeyError:
+        has = bool(int(_eval("has('%s')" % name)))
+        _vim_features[name] = has
+        return has
+
+_vim_features = {}
+
+def _capture_output(cmd):
+    """ returns the output of running cmd, or None if there wasn't any """
+    cmd = escape_string_sq(cmd)
+    if _has_function("execute"):
+        out = _eval("execute('%s')" % cmd)
+    else:
+        var = _new_capture_var()
+        _vim_command("redir => %s | silent execute '%s' | redir END" % (var,
+            cmd))
+        out = _eval(var)
+        _vim_command("unlet %s" % var)
+    return out or None
+
+def _new_capture_var():
+    global _capture_counter
+    _capture_counter += 1
+    return "g:_snake_capture_%d" % _capture_counter
+
+def iter_command_output(cmd, chunk_size=1000):
+    """ runs cmd and yields its output one line at a time.  the output is kept
+    on the vim side and fetched chunk_size lines at a time, so commands with
+    huge output don't need to fit in memory all at once """
+    var = _new_capture_var()
+    escaped = escape_string_sq(cmd)
+    if _has_function("execute"):
+        command("let %s = split(execute('%s'), \"\\n\")" % (var, escaped))
+    else:
+        command("redir => %s | silent execute '%s' | redir END" % (var,
+            escaped))
+        command("let %s = split(%s, \"\\n\")" % (var, var))
+
+    try:
+        total = int(_eval("len(%s)" % var))
+        for start in range(0, total, chunk_size):
+            end = start + chunk_size - 1
+            for line in _eval("%s[%d:%d]" % (var, start, end)):
+                yield line
+    finally:
+        command("unlet! %s" % var)
+
+
+def dispatch_mapped_function(handle):
     """ this function will be called by any function mapped to a key in visual
     mode.  because we can't tell vim "hey, call this arbitrary, possibly
     anonymous, callable on key press", we have a single dispatch function to do
     that work for vim """
-    try:
-        fn = _mapped_functions[key]
-    except KeyError:
-        raise Exception("""unable to find mapped function with id() == %s.
+    registration = _lookup_registration(handle)
+    if registration is None:
+        raise Exception("""unable to find mapped function with handle %s.
             Something bad related to reloading has happened.  Typically, this is
             because you set up a key_map inside of a @when_buffer_is and
             reloaded your ~/.vim.py.  The result is that the function decorated
             by @when_buffer_is isn't re-run with updated key_mappings, so the
-            key_mappings have references to old callbacks.""" % key)
+            key_mappings have references to old callbacks.""" % handle)
+    return _call_registered(registration.name, registration.fn)
+
+def dispatch_autocmd(handle, event, bufnr, changedtick, file, match):
+    """ called by SnakeAutocmd() in prelude.vim for autocommands set up by
+    on_autocmd.  the arguments are filled in by vim as the event fires """
+    registration = _lookup_registration(handle)
+    if registration is None:
+        raise Exception("unable to find autocommand handler with handle %s"
+                % handle)
+    ctx = AutoCommandContext(event, bufnr, changedtick, file, match)
+    return registration.fn(ctx)
+
+def _lookup_registration(handle):
+    """ returns the _Registration for handle, or None.  if ~/.vimrc.py was
+    replayed from a snapshot, the functions it registered don't exist until
+    it's imported, which happens the first time one of them is needed """
+    registration = _mapped_functions.get(handle)
+    if registration is None and plugin_loader.load_deferred_vimrc():
+        registration = _mapped_functions.get(handle)
+    return registration
+
+class _Registration(object):
+    """ an entry in our registry of functions that vim can call """
+
+    __slots__ = ("fn", "name", "buf")
+
+    def __init__(self, fn, name, buf):
+        self.fn = fn
+        self.name = name
+        self.buf = buf
+
+def _definition_site(fn):
+    """ a name for fn that is the same every time the code defining it runs,
+    based on where it was defined """
+    while isinstance(fn, partial):
+        fn = fn.func
+    code = getattr(fn, "__code__", None)
+    name = getattr(fn, "__name__", type(fn).__name__)
+    if code is None:
+        return name
+    return "%s:%d:%s" % (code.co_filename, code.co_firstlineno, name)
+
+def _registry_handle(name, buf):
+    """ the string vim uses to refer to a registration.  it's derived from the
+    registration's name, so it's stable across reloads """
+    import hashlib
+    if buf is not None:
+        name = "%s@%d" % (name, buf)
+    return hashlib.md5(name.encode("utf-8")).hexdigest()[:16]
+
+def register_fn(fn, key=None, local=False):
+    """ takes a function and returns a string handle that we can use to call the
+    function via the "python" command in vimscript.  key names what the
+    function is registered for, like a key mapping, so that registering
+    something else for the same key replaces it instead of piling up.  without
+    a key, we use where fn was defined.  if local is true, the registration
+    belongs to the current buffer, and goes away when the buffer is wiped """
+    buf = None
+    if local:
+        buf = _current_buffer().number
+        _watch_buffer_wipeouts()
+
+    if key is None:
+        name = _definition_site(fn)
+        # a different function from the same place, like two closures made by
+        # the same factory, shouldn't replace the first one
+        base, n = name, 1
+        while True:
+            existing = _mapped_functions.get(_registry_handle(name, buf))
+            if existing is None or existing.fn is fn:
+                break
+            n += 1
+            name = "%s#%d" % (base, n)
     else:
-        return fn()
-
-def _generate_autocommand_name(fn):
-    """ takes a function and returns a name that is unique to the function and
-    where it was defined.  the name must be reproducible between startup calls
-    because its for an auto command group, and we must clear the old group out
-    when reloading
-    
-    http://learnvimscriptthehardway.stevelosh.com/chapters/14.html#clearing-groups
-    """
-    src = None
-    try:
-        src = inspect.getsourcefile(fn)
-    except TypeError:
-        pass
+        name = key
 
-    if not src:
-        src = "."
-    return src + ":" + fn.__name__
+    handle = _registry_handle(name, buf)
+    _mapped_functions[handle] = _Registration(fn, name, buf)
+    return "snake.dispatch_mapped_function('%s')" % handle
+
+def unregister_fn(key, local=False):
+    """ removes whatever was registered with register_fn for key.  returns
+    whether there was anything to remove """
+    buf = None
+    if local:
+        buf = _current_buffer().number
+    return _mapped_functions.pop(_registry_handle(key, buf), None) is not None
+
+def _watch_buffer_wipeouts():
+    """ sets up, once, an autocommand that drops a buffer's registrations when
+    the buffer is wiped out """
+    global _watching_wipeouts
+    if _watching_wipeouts:
+        return
+    _watching_wipeouts = True
+    with batch():
+        command("augroup snake_registry")
+        command("autocmd!")
+        command("autocmd BufWipeout * :%s snake._forget_buffer()" % PYTHON_CMD)
+        command("augroup END")
+
+_watching_wipeouts = False
+
+def _forget_buffer(buf=None):
+    """ removes every registration belonging to buffer buf, which defaults to
+    the buffer an autocommand is firing for """
+    if buf is None:
+        buf = int(_eval("expand('<abuf>')"))
+    for handle, registration in list(_mapped_functions.items()):
+        if registration.buf == buf:
+            del _mapped_functions[handle]
+
+def _dead_registry_buffers():
+    """ the buffers that registrations belong to, but that no longer exist """
+    bufs = sorted(set(r.buf for r in _mapped_functions.values()
+        if r.buf is not None))
+    if not bufs:
+        return set()
+    exists = _eval("map(%s, 'bufexists(v:val)')" % bufs)
+    return set(buf for buf, e in zip(bufs, exists) if not int(e))
+
+def registry_info():
+    """ returns a dictionary describing the function registry: its total
+    size, how many entries are buffer-local, and the names of any stale
+    entries, which belong to buffers that no longer exist """
+    dead = _dead_registry_buffers()
+    stale = sorted("%s@%d" % (r.name, r.buf) for r in
+            _mapped_functions.values() if r.buf in dead)
+    return {
+        "size": len(_mapped_functions),
+        "buffer_local": sum(1 for r in _mapped_functions.values()
+            if r.buf is not None),
+        "stale": stale,
+    }
+
+def collect_registry():
+    """ removes stale registry entries, and returns how many were removed """
+    before = len(_mapped_functions)
+    for buf in _dead_registry_buffers():
+        _forget_buffer(buf)
+    return before - len(_mapped_functions)
+
+
+# how many of the most recent call times we keep per function, for percentiles
+PROFILE_MAX_SAMPLES = 10000
+
+class _ProfileStats(object):
+    """ what the profiler knows about one registered function """
+
+    __slots__ = ("name", "calls", "total", "vim_time", "samples")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.vim_time = 0.0
+        self.samples = deque(maxlen=PROFILE_MAX_SAMPLES)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def as_dict(self):
+        """ times are in milliseconds """
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "total": self.total * 1000,
+            "mean": self.total * 1000 / max(self.calls, 1),
+            "p50": self.percentile(50) * 1000,
+            "p95": self.percentile(95) * 1000,
+            "p99": self.percentile(99) * 1000,
+            "max": max(self.samples or [0]) * 1000,
+            "vim": self.vim_time * 1000,
+            "python": (self.total - self.vim_time) * 1000,
+        }
+
+class _Profiler(object):
+    __slots__ = ("stats", "vim_time")
+
+    def __init__(self):
+        self.stats = {}
+        # a running total of the time spent in vim.eval and vim.command.
+        # _vim_eval and _vim_command add to it
+        self.vim_time = 0.0
+
+def _call_registered(name, fn, *args):
+    """ calls a function that vim called through the registry, timing it if
+    the profiler is on """
+    profiler = _profiler
+    if profiler is None:
+        return fn(*args)
+
+    start, vim_start = time.time(), profiler.vim_time
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.time() - start
+        stats = profiler.stats.get(name)
+        if stats is None:
+            stats = profiler.stats[name] = _ProfileStats(name)
+        stats.calls += 1
+        stats.total += elapsed
+        stats.vim_time += profiler.vim_time - vim_start
+        stats.samples.append(elapsed)
+
+def enable_profiler():
+    """ starts timing every function that vim calls through snake: key maps,
+    abbreviations and autocommand handlers.  turning it on again starts over """
+    global _profiler
+    _profiler = _Profiler()
+
+def disable_profiler():
+    """ stops profiling.  what has been recorded so far is thrown away """
+    global _profiler
+    _profiler = None
+
+PROFILE_SORT_KEYS = ("p99", "p95", "p50", "mean", "max", "total", "calls",
+        "vim", "python")
+
+def profile_stats(sort="p99"):
+    """ returns a list of dictionaries, one per profiled function, slowest
+    first by sort.  times are in milliseconds.  "vim" is the time spent
+    inside of vim.eval and vim.command, and "python" is the rest """
+    if sort not in PROFILE_SORT_KEYS:
+        raise ValueError("sort must be one of %s" %
+                ", ".join(PROFILE_SORT_KEYS))
+    if _profiler is None:
+        return []
+    stats = [s.as_dict() for s in _profiler.stats.values()]
+    stats.sort(key=lambda s: (-s[sort], s["name"]))
+    return stats
+
+def profile_report(sort="p99"):
+    """ shows profile_stats() as a table in a scratch buffer, and returns the
+    buffer """
+    global _profile_buffer
+    columns = ("calls", "total", "mean", "p50", "p95", "p99", "max", "vim")
+    lines = ["%10s" * len(columns) % columns + "  function",
+            "(times in ms, sorted by %s)" % sort]
+    for s in profile_stats(sort):
+        lines.append("%10d" % s["calls"] + "".join("%10.2f" % s[c] for c in
+            columns[1:]) + "  " + s["name"])
+
+    if _profile_buffer is None or \
+            not int(_eval("bufexists(%d)" % _profile_buffer)):
+        _profile_buffer = new_buffer("snake-profile")
+    set_buffer_lines(_profile_buffer, lines)
+    return _profile_buffer
+
+def dump_profile(path, sort="p99"):
+    """ writes profile_stats() to path as json, for looking at later """
+    import json
+    with open(path, "w") as h:
+        json.dump(profile_stats(sort), h, indent=2, sort_keys=True)
+
+_profiler = None
+_profile_buffer = None
 
-def register_fn(fn):
-    """ takes a function and returns a string handle that we can use to call the
-    function via the "python" command in vimscript """
-    fn_key = id(fn)
-    _mapped_functions[fn_key] = fn
-    return "snake.dispatch_mapped_function(%s)" % fn_key
 
 @contextmanager
-def preserve_cursor():
+def preserve_cursor(snapshot=None):
     """ persists cursor state across context. does not work in visual mode,
-    because visual mode has 2 cursor locations, for start and end cursors """
-    p = get_cursor_position()
+    because visual mode has 2 cursor locations, for start and end cursors.  if
+    you already have a snapshot from state(), pass it in to save a call into
+    vim """
+    if snapshot is None:
+        p = get_cursor_position()
+    else:
+        p = snapshot.cursor
     try:
         yield
     finally:
@@ -141,7 +879,7 @@ def preserve_mode():
                 keys("gv")
         elif cur_mode in visual_modes:
             if old_mode == "n":
-                keys("\<esc>")
+                keys(r"\<esc>")
 
 @contextmanager
 def preserve_registers(*regs):
@@ -182,22 +920,36 @@ def debug(msg, persistent=False):
     command("%s '%s'" % (cmd, escape_string_sq(msg)))
 
 
-def abbrev(word, expansion, local=False):
+@_startup_timed(lambda word, *args, **kwargs: "abbrev %s" % word)
+def abbrev(word, expansion, local=False, expr=False):
     """ creates an abbreviation in insert mode.  expansion can be a string to
-    expand to or a function that returns a value to serve as the expansion """
+    expand to or a function that returns a value to serve as the expansion.
+
+    with expr=True, a function is called from an <expr> abbreviation, which
+    skips the expression register's command line, so it's faster.  but vim
+    doesn't let <expr> abbreviations change the buffer or press keys, so only
+    use it for functions that just return their expansion """
 
     cmd = "iabbrev"
     if local:
         cmd = cmd + " <buffer>"
+    fn_key = "%s %s" % (cmd, word)
 
     if callable(expansion):
-        fn_str = register_fn(expansion)
-        expansion = "<C-r>=%s('%s')<CR>" % (PYEVAL, escape_string_sq(fn_str))
+        fn_str = register_fn(expansion, key=fn_key, local=local)
+        call = "%s('%s')" % (_get_pyeval(), escape_string_sq(fn_str))
+        if expr:
+            cmd = cmd.replace("iabbrev", "iabbrev <expr>")
+            expansion = call
+        else:
+            expansion = "<C-r>=%s<CR>" % call
+    else:
+        unregister_fn(fn_key, local=local)
 
     command("%s %s %s" % (cmd, word, expansion))
 
 def expand(stuff):
-    return vim.eval("expand('%s')" % escape_string_sq(stuff))
+    return _eval("expand('%s')" % escape_string_sq(stuff))
      
 def get_current_dir():
     return dirname(get_current_file())
@@ -209,22 +961,60 @@ def get_alternate_file():
     return expand("#:p")
 
 def get_cur_line():
-    return int(vim.eval("line('.')"))
+    return int(_eval("line('.')"))
 
 def get_mode():
-    return vim.eval("mode(1)")
+    return _eval("mode(1)")
 
 def get_num_lines():
-    return int(vim.eval("line('$')"))
+    return int(_eval("line('$')"))
+
+def is_last_line(snapshot=None):
+    """ returns whether the cursor is on the last line of the buffer.  pass in
+    a snapshot from state() to avoid querying vim again """
+    if snapshot is None:
+        snapshot = state()
+    return snapshot.is_last_line()
+
+
+_STATE_EXPR = "[mode(1), getpos('.'), line('$'), bufnr('%'), winnr(), \
+b:changedtick, line('w0'), line('w$')]"
+
+class EditorState(object):
+    """ a snapshot of commonly needed editor state, fetched from vim all at
+    once.  see state() """
 
-def is_last_line():
-    row, _ = get_cursor_position()
-    return row == get_num_lines()
+    __slots__ = ("mode", "cursor", "num_lines", "buffer", "window",
+            "changedtick", "visible_range")
+
+    def __init__(self, raw):
+        mode, pos, num_lines, buf, win, tick, top, bottom = raw
+        self.mode = mode
+        self.cursor = (int(pos[1]), int(pos[2]))
+        self.num_lines = int(num_lines)
+        self.buffer = int(buf)
+        self.window = int(win)
+        self.changedtick = int(tick)
+        self.visible_range = (int(top), int(bottom))
+
+    def is_last_line(self):
+        return self.cursor[0] == self.num_lines
+
+    def __repr__(self):
+        return "<EditorState mode=%r cursor=%r buffer=%d window=%d>" % (
+                self.mode, self.cursor, self.buffer, self.window)
+
+def state():
+    """ returns an EditorState snapshot of the mode, cursor, line count,
+    buffer, window, changedtick and visible line range, using a single call
+    into vim.  the snapshot doesn't update, so fetch a new one after you've
+    changed something """
+    return EditorState(_eval(_STATE_EXPR))
 
 
 def get_cursor_position():
     #return vim.current.window.cursor
-    _, start_row, start_col, _ = vim.eval("getpos('.')")
+    _, start_row, start_col, _ = _eval("getpos('.')")
     return int(start_row), int(start_col)
 
 def set_cursor_position(pos):
@@ -267,8 +1057,9 @@ def multi_let(namespace, **name_values):
     """ convenience function for setting multiple globals at once in your
     .vimrc.py, all related to a plugin.  the first argument is a namespace to be
     appended to the front of each name/value pair. """
-    for name, value in name_values.items():
-        let(name, value, namespace=namespace)
+    with batch():
+        for name, value in name_values.items():
+            let(name, value, namespace=namespace)
 
 def _serialize_obj(obj):
     if isinstance(obj, str):
@@ -292,8 +1083,11 @@ let_buffer_local = partial(let, scope=NS_BUFFER)
 
 def get(name, namespace=None, scope=NS_GLOBAL):
     """ gets a variable """
+    # flush outside of our try, so that an error from a batched command isn't
+    # mistaken for an undefined variable
+    _flush_batch()
     try:
-        val = vim.eval(_compose_let_name(name, namespace, scope))
+        val = _eval(_compose_let_name(name, namespace, scope))
     except vim.error as e:
         val = None
     return val
@@ -324,7 +1118,7 @@ def search(s, wrap=True, backwards=False, move=True, curline=False):
 
         cmd = "search('{str}', '{flags}'{stopline})".format(str=s,
                 flags="".join(flags), stopline=stopline)
-        line = int(vim.eval(cmd))
+        line = int(_eval(cmd))
         match = line != 0
 
         if match:
@@ -341,7 +1135,7 @@ def search(s, wrap=True, backwards=False, move=True, curline=False):
     return pos
 
 def get_leader():
-    return vim.eval("mapleader")
+    return _eval("mapleader")
 
 def keys(k, keymaps=True):
     """ feeds keys into vim as if you pressed them """
@@ -362,7 +1156,7 @@ def keys(k, keymaps=True):
     command('execute "%s %s"' % (cmd, k))
 
 def get_register(name):
-    val = vim.eval("@%s" % name)
+    val = _eval("@%s" % name)
     if val == "":
         val = None
     return val
@@ -374,39 +1168,215 @@ def set_register(name, val):
     val = escape_string_dq(str(val))
     command('let @%s = "%s"' % (name, val))
 
-@preserve_state()
+def _to_text(s, encoding):
+    """ python 2's vim module hands us bytes, which we can't index by
+    character.  python 3's vim module already hands us text """
+    if not IS_PY3 and isinstance(s, bytes):
+        s = s.decode(encoding, "replace")
+    return s
+
+def _from_text(s, encoding):
+    """ the inverse of _to_text, for sending text back into vim """
+    if not IS_PY3:
+        s = s.encode(encoding)
+    return s
+
+def _byte_col_to_index(line, col, encoding):
+    """ vim's columns are byte offsets.  this converts one into a character
+    index into line, which is text """
+    errors = "surrogateescape" if IS_PY3 else "replace"
+    raw = line.encode(encoding, errors)
+    return len(raw[:col].decode(encoding, errors))
+
+def _index_to_byte_col(line, index, encoding):
+    errors = "surrogateescape" if IS_PY3 else "replace"
+    return len(line[:index].encode(encoding, errors))
+
+def _parse_iskeyword(option):
+    """ turns the value of the 'iskeyword' option into a table of which of the
+    first 256 characters are keyword characters.  see :help isfname for the
+    format """
+    try:
+        return _iskeyword_tables[option]
+    except KeyError:
+        pass
+
+    def to_ord(part):
+        if part.isdigit():
+            return int(part)
+        return ord(part)
+
+    # python 2's chr() gives us bytes, whose isalpha() ignores latin1
+    to_char = chr if IS_PY3 else unichr
+
+    table = [False] * 256
+    for part in option.split(","):
+        if not part:
+            continue
+
+        include = True
+        if part.startswith("^") and len(part) > 1:
+            include = False
+            part = part[1:]
+
+        if part == "@":
+            for i in range(256):
+                if to_char(i).isalpha():
+                    table[i] = include
+            continue
+
+        dash = part.find("-", 1)
+        if dash != -1:
+            low, high = to_ord(part[:dash]), to_ord(part[dash + 1:])
+        else:
+            low = high = to_ord(part)
+
+        for i in range(low, min(high, 255) + 1):
+            table[i] = include
+
+    _iskeyword_tables[option] = table
+    return table
+
+_iskeyword_tables = {}
+
+def _char_class(c, keyword_table):
+    """ mimics how vim groups characters into words: blanks, keyword
+    characters, and everything else """
+    if c in " \t":
+        return 0
+    o = ord(c)
+    if o < 256:
+        is_keyword = keyword_table[o]
+    else:
+        is_keyword = c.isalnum()
+    return 2 if is_keyword else 1
+
+def _word_bounds(line, col, keyword_table):
+    """ python version of vim's "iw" text object.  returns the (start, end)
+    indices of the word at col, or None for an empty line """
+    if not line:
+        return None
+    col = min(col, len(line) - 1)
+    cls = _char_class(line[col], keyword_table)
+
+    start = col
+    while start > 0 and _char_class(line[start - 1], keyword_table) == cls:
+        start -= 1
+
+    end = col + 1
+    while end < len(line) and _char_class(line[end], keyword_table) == cls:
+        end += 1
+    return start, end
+
+def _quote_bounds(line, col, quote, escapes):
+    """ python version of vim's i" text object.  returns the indices of the
+    opening and closing quote around col, or None if there aren't any """
+    quotes = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c in escapes:
+            i += 2
+            continue
+        if c == quote:
+            quotes.append(i)
+        i += 1
+
+    # if we're on a quote, vim pairs quotes from the start of the line to
+    # figure out if it's opening or closing
+    if col in quotes:
+        idx = quotes.index(col)
+        if idx % 2:
+            return quotes[idx - 1], col
+        if idx + 1 < len(quotes):
+            return col, quotes[idx + 1]
+        return None
+
+    before = [q for q in quotes if q < col]
+    after = [q for q in quotes if q > col]
+    if before and after:
+        return before[-1], after[0]
+    if not before and len(after) >= 2:
+        return after[0], after[1]
+    return None
+
+def _get_cursor_context():
+    """ fetches everything our text object functions need in a single call into
+    vim.  returns (row, col, line, encoding, keyword_table, quote_escapes),
+    where line is text and col is a character index into it """
+    pos, line, encoding, iskeyword, escapes = _eval("[getpos('.'), \
+getline('.'), &encoding, &iskeyword, &quoteescape]")
+    line = _to_text(line, encoding)
+    row = int(pos[1])
+    col = _byte_col_to_index(line, int(pos[2]) - 1, encoding)
+    return (row, col, line, encoding, _parse_iskeyword(iskeyword),
+            _to_text(escapes, encoding))
+
+def _replace_line(row, line, encoding):
+    """ replaces line number row in the current buffer with line, which may
+    contain newlines """
+    lines = [_from_text(l, encoding) for l in line.split("\n")]
+    _set_lines(_current_buffer(), row - 1, row, lines)
+
 def get_word():
     """ gets the word under the cursor """
-    keys('"0yiw')
-    return get_register("0")
+    row, col, line, encoding, keywords, _ = _get_cursor_context()
+    bounds = _word_bounds(line, col, keywords)
+    if bounds is None:
+        return None
+    start, end = bounds
+    return _from_text(line[start:end], encoding)
 
 def delete_word():
     """ deletes the word under the cursor """
-    # we don't do a @preserve_state because we want the cursor to move as the
-    # word is deleted
-    with preserve_mode():
-        with preserve_registers("0"):
-            keys('"0diw')
-            return get_register("0")
-
-@preserve_state()
+    # the cursor moves to where the word was, like "diw" does
+    row, col, line, encoding, keywords, _ = _get_cursor_context()
+    bounds = _word_bounds(line, col, keywords)
+    if bounds is None:
+        return None
+    start, end = bounds
+    new_line = line[:start] + line[end:]
+
+    col = min(start, max(len(new_line) - 1, 0))
+    col = _index_to_byte_col(new_line, col, encoding) + 1
+    cmd = "call setline(%d, '%s') | call cursor(%d, %d)" % (row,
+            escape_string_sq(new_line), row, col)
+    command(_from_text(cmd, encoding))
+    return _from_text(line[start:end], encoding)
+
 def replace_word(rep):
     """ replaces the word under the cursor with rep """
-    set_register("0", rep)
-    keys('viw"0p')
+    row, col, line, encoding, keywords, _ = _get_cursor_context()
+    bounds = _word_bounds(line, col, keywords)
+    if bounds is None:
+        bounds = (0, 0)
+    start, end = bounds
+
+    if not isinstance(rep, (type(""), bytes)):
+        rep = str(rep)
+    rep = _to_text(rep, encoding)
+    _replace_line(row, line[:start] + rep + line[end:], encoding)
 
-@preserve_state()
 def get_in_quotes():
     """ gets the string beneath the cursor that lies in either double or single
     quotes """
-    keys("yi\"")
-    val = get_register("0")
-    if val is None:
-        keys("yi'")
-        val = get_register("0")
-    return val
-
-
+    row, col, line, encoding, _, escapes = _get_cursor_context()
+    for quote in ('"', "'"):
+        bounds = _quote_bounds(line, col, quote, escapes)
+        if bounds is not None and bounds[1] - bounds[0] > 1:
+            return _from_text(line[bounds[0] + 1:bounds[1]], encoding)
+    return None
+
+
+def _num_args(fn):
+    """ how many positional arguments fn takes """
+    import inspect
+    getargspec = getattr(inspect, "getfullargspec", None) or \
+            inspect.getargspec
+    return len(getargspec(fn).args)
+
+@_startup_timed(lambda key, maybe_fn=None, *args, **kwargs: None if maybe_fn
+        is None else "key_map %s" % key)
 def key_map(key, maybe_fn=None, mode=NORMAL_MODE, recursive=False,
         local=False, **addl_options):
     """ a function to bind a key to some action, be it a vim action or a python
@@ -431,7 +1401,7 @@ def key_map(key, maybe_fn=None, mode=NORMAL_MODE, recursive=False,
 
     if callable(maybe_fn):
         fn = maybe_fn
-        fn_takes_selection = len(inspect.getargspec(fn).args)
+        uses_cmd = get_dispatch_mode() == DISPATCH_CMD
 
         # if we're mapping in visual mode, we're going to assume that the
         # function takes the contents of the visual selection.  if the function
@@ -439,8 +1409,14 @@ def key_map(key, maybe_fn=None, mode=NORMAL_MODE, recursive=False,
         # think these are reasonable assumptions
         if mode == VISUAL_MODE:
             old_fn = fn
+            fn_takes_selection = _num_args(fn)
             @wraps(fn)
             def wrapped():
+                # <Cmd> mappings run while we're still in visual mode.  leave
+                # it, like ":" would have, so the function sees the same state
+                if uses_cmd:
+                    keys(r"\<esc>", keymaps=False)
+
                 # only if we're expecting a selection should we pass the
                 # selection.  this has side effects
                 if fn_takes_selection:
@@ -455,15 +1431,47 @@ def key_map(key, maybe_fn=None, mode=NORMAL_MODE, recursive=False,
                     reselect_last_visual_selection()
             fn = wrapped
 
-        call = register_fn(fn)
-        command("%s <silent> %s :%s %s<CR>" % (map_command, key, PYTHON_CMD, call))
+        call = register_fn(fn, key="%s %s" % (map_command, key), local=local)
+        if uses_cmd:
+            rhs = "<Cmd>%s %s<CR>" % (PYTHON_CMD, call)
+        else:
+            rhs = ":%s %s<CR>" % (PYTHON_CMD, call)
+        command("%s <silent> %s %s" % (map_command, key, rhs))
 
     else:
+        # if a python function was mapped here before, it's not needed anymore
+        unregister_fn("%s %s" % (map_command, key), local=local)
         command("%s %s %s" % (map_command, key, maybe_fn))
 
 
 visual_key_map = partial(key_map, mode=VISUAL_MODE)
 
+# how key mappings call into python.  DISPATCH_CMDLINE maps keys to
+# ":python ...<CR>", which goes through command-line mode, firing CmdlineEnter
+# and CmdlineLeave on every key press.  DISPATCH_CMD uses a <Cmd> mapping
+# instead, which runs the same command without ever leaving the current mode
+DISPATCH_CMDLINE = "cmdline"
+DISPATCH_CMD = "cmd"
+
+_dispatch_mode = None
+
+def get_dispatch_mode():
+    """ returns how key_map calls python functions.  unless it has been set
+    with set_dispatch_mode, we use <Cmd> mappings if vim supports them """
+    global _dispatch_mode
+    if _dispatch_mode is None:
+        if _has_feature("patch-8.2.1978"):
+            _dispatch_mode = DISPATCH_CMD
+        else:
+            _dispatch_mode = DISPATCH_CMDLINE
+    return _dispatch_mode
+
+def set_dispatch_mode(mode):
+    """ chooses how future key_map calls dispatch to python, DISPATCH_CMD or
+    DISPATCH_CMDLINE.  None goes back to detecting it """
+    global _dispatch_mode
+    _dispatch_mode = mode
+
 def redraw():
     command("redraw!")
 
@@ -473,47 +1481,223 @@ def step():
     redraw()
     time.sleep(1)
 
-@preserve_state()
+# vim's MAXCOL.  it's the column of the end of a linewise selection, and the
+# cursor's wanted column after a "$"
+_MAXCOL = 2147483647
+_BLOCKWISE_VISUAL = "\x16"
+
+def _char_width(c, col, tabstop):
+    """ the number of screen cells character c takes up, if it starts at
+    screen column col """
+    if c == "\t":
+        return tabstop - (col % tabstop)
+    if ord(c) >= 0x1100:
+        import unicodedata
+        if unicodedata.east_asian_width(c) in ("W", "F"):
+            return 2
+    return 1
+
+def _display_span(line, index, tabstop):
+    """ returns the first and last screen columns (0-based) of the character
+    at index """
+    col = 0
+    for c in line[:index]:
+        col += _char_width(c, col, tabstop)
+    width = 1
+    if index < len(line):
+        width = _char_width(line[index], col, tabstop)
+    return col, col + width - 1
+
+def _display_block(line, left, right, tabstop):
+    """ returns (start, end, lead, trail), where start and end are the indices
+    of the characters in line that are on the screen columns left to right,
+    inclusive.  a tab or wide character can straddle an edge of the block, and
+    lead and trail are how many of its cells stick out on the left and
+    right """
+    start = end = None
+    lead = trail = 0
+    col = 0
+    for i, c in enumerate(line):
+        if col > right:
+            break
+        width = _char_width(c, col, tabstop)
+        if col + width > left:
+            if start is None:
+                start = i
+                lead = max(left - col, 0)
+            end = i + 1
+            trail = max(col + width - 1 - right, 0)
+        col += width
+
+    if start is None:
+        start = end = min(len(line), _index_at_display_col(line, left,
+            tabstop))
+    return start, end, lead, trail
+
+def _block_text(line, block, tabstop):
+    """ returns the text that yanking a block would take from line, where block
+    comes from _display_block.  like vim, the parts of a tab or wide character
+    that are inside the block come out as spaces """
+    start, end, lead, trail = block
+    text = line[start:end]
+    if not (lead or trail):
+        return text
+    first_left, first_right = _display_span(line, start, tabstop)
+    if end - start == 1:
+        return " " * (first_right - first_left + 1 - lead - trail)
+    if lead:
+        text = " " * (first_right - first_left + 1 - lead) + text[1:]
+    if trail:
+        last_left, last_right = _display_span(line, end - 1, tabstop)
+        text = text[:-1] + " " * (last_right - last_left + 1 - trail)
+    return text
+
+def _index_at_display_col(line, target, tabstop):
+    col = 0
+    for i, c in enumerate(line):
+        if col >= target:
+            return i
+        col += _char_width(c, col, tabstop)
+    return len(line)
+
+class _VisualContext(object):
+    """ everything we need to know about a visual selection, fetched from vim
+    in a single call.  rows and cols are 1-based, and cols are in bytes """
+
+    __slots__ = ("mode", "start", "end", "active", "encoding", "selection",
+            "tabstop", "to_eol")
+
+    def __init__(self, raw):
+        (cur_mode, v_pos, cur_pos, start_pos, end_pos, last_mode,
+                self.encoding, self.selection, tabstop, curswant) = raw
+        self.tabstop = int(tabstop)
+
+        # if we're still in visual mode, the '< and '> marks haven't been set
+        # yet, so we use the cursor and the other end of the selection instead
+        self.active = cur_mode in ("v", "V", _BLOCKWISE_VISUAL)
+        if self.active:
+            self.mode = cur_mode
+            self.start, self.end = sorted([(int(v_pos[1]), int(v_pos[2])),
+                (int(cur_pos[1]), int(cur_pos[2]))])
+            # a "$" in blockwise mode extends every line of the block to its
+            # end, and only shows up in the cursor's wanted column
+            self.to_eol = int(curswant) >= _MAXCOL
+        else:
+            self.mode = last_mode
+            self.start = (int(start_pos[1]), int(start_pos[2]))
+            self.end = (int(end_pos[1]), int(end_pos[2]))
+            # the wanted column is gone once we leave visual mode.  _visual_spans
+            # works it out from the marks instead
+            self.to_eol = None
+
+_VISUAL_CONTEXT_EXPR = "[mode(), getpos('v'), getpos('.'), getpos(\"'<\"), \
+getpos(\"'>\"), visualmode(), &encoding, &selection, &tabstop, \
+getcurpos()[4]]"
+
+def _get_visual_context():
+    """ returns a _VisualContext for the current or last visual selection, or
+    None if there has never been one """
+    context = _VisualContext(_eval(_VISUAL_CONTEXT_EXPR))
+    if not context.mode or context.start[0] == 0:
+        return None
+    return context
+
+def _visual_spans(lines, context):
+    """ takes the lines of the buffer covered by a visual selection and returns
+    a (start, end) index pair for each, describing which part of that line is
+    selected.  for a blockwise selection, each is a (start, end, lead, trail)
+    tuple from _display_block instead """
+    start_col, end_col = context.start[1], context.end[1]
+    encoding, tabstop = context.encoding, context.tabstop
+    exclusive = context.selection == "exclusive"
+
+    if context.mode == "V":
+        return [(0, len(line)) for line in lines]
+
+    start_idx = _byte_col_to_index(lines[0], start_col - 1, encoding)
+    if end_col < _MAXCOL:
+        end_idx = _byte_col_to_index(lines[-1], end_col - 1, encoding)
+    else:
+        end_idx = len(lines[-1])
+
+    if context.mode == _BLOCKWISE_VISUAL:
+        to_eol = context.to_eol
+        if to_eol is None:
+            # after a "$", vim leaves the corner the cursor was on just past
+            # the end of its line, which no other block can do
+            to_eol = any(line and col > _index_to_byte_col(line, len(line),
+                encoding) for line, col in ((lines[0], start_col),
+                    (lines[-1], end_col)))
+
+        start_left, start_right = _display_span(lines[0], start_idx, tabstop)
+        end_left, end_right = _display_span(lines[-1], end_idx, tabstop)
+        # the block may have been selected right to left
+        left = min(start_left, end_left)
+        right = max(start_right, end_right)
+        if to_eol:
+            right = sys.maxsize
+        elif exclusive:
+            right = max(start_left, end_left) - 1
+        return [_display_block(line, left, right, tabstop) for line in lines]
+
+    if end_col < _MAXCOL and not exclusive:
+        end_idx += 1
+    end_idx = min(end_idx, len(lines[-1]))
+
+    if len(lines) == 1:
+        return [(start_idx, end_idx)]
+    return [(start_idx, len(lines[0]))] + [(0, len(line)) for line in
+            lines[1:-1]] + [(0, end_idx)]
+
+def _selects_newline(lines, context):
+    """ whether a charwise selection runs past the end of its last line, like
+    after "v$".  then yanking or deleting it takes the line break too """
+    if context.mode != "v" or context.selection == "exclusive":
+        return False
+    end_col = context.end[1]
+    if end_col >= _MAXCOL:
+        return True
+    line = lines[-1]
+    return _byte_col_to_index(line, end_col - 1, context.encoding) >= len(line)
+
 def get_visual_range():
     """ returns the start (row, col) and end (row, col) of our range in visual
     mode """
-    keys("\<esc>gv")
-    _, start_row, start_col, _ = vim.eval("getpos('v')")
-    start_row = int(start_row)
-    start_col = int(start_col)
-    with preserve_cursor():
-        keys("`>")
-        end_row, end_col = get_cursor_position()
-    return (start_row, start_col), (end_row, end_col)
+    context = _get_visual_context()
+    if context is None:
+        return None
+    end_row, end_col = context.end
+    # linewise selections end at vim's MAXCOL, so clamp it to the last
+    # character of the line, like jumping to `> would
+    if end_col >= _MAXCOL:
+        line = _to_text(_current_buffer()[end_row - 1], context.encoding)
+        end_col = max(_index_to_byte_col(line, len(line), context.encoding), 1)
+    return context.start, (end_row, end_col)
 
 def set_buffer(buf):
     command("buffer %d" % buf)
 
 def get_current_buffer():
-    return int(vim.eval("bufnr('%')"))
+    return int(_eval("bufnr('%')"))
 
 def get_num_buffers():
-    i = int(vim.eval("bufnr('$')"))
-    j = 0
-    while i >= 1:
-        listed = bool(int(vim.eval("buflisted(%d)" % i)))
-        if listed:
-            j += 1
-        i -= 1
-    return j
+    """ returns the number of listed buffers """
+    # vim does the counting, so this is a single call no matter how many
+    # buffers there are
+    return int(_eval("len(filter(range(1, bufnr('$')), 'buflisted(v:val)'))"))
 
 
 def get_current_window():
-    return int(vim.eval("winnr()"))
+    return int(_eval("winnr()"))
 
 def get_num_windows():
-    return int(vim.eval("winnr('$')"))
+    return int(_eval("winnr('$')"))
 
 def get_window_of_buffer(buf):
-    return int(vim.eval("bufwinnr(%d)" % buf))
+    return int(_eval("bufwinnr(%d)" % buf))
 
 def get_buffer_in_window(win):
-    return int(vim.eval("winbufnr(%d)" % win))
+    return int(_eval("winbufnr(%d)" % win))
 
 def new_window(size=None, vertical=False):
     if vertical:
@@ -535,11 +1719,12 @@ def multi_set_option(*names):
     """ convenience function for setting a ton of options at once, for example,
     in your .vimrc.py file.  regular strings are treated as options with no
     values, while list/tuple elements are considered name/value pairs"""
-    for name in names:
-        val = None
-        if isinstance(name, (list, tuple)):
-            name, val = name
-        set_option(name, val)
+    with batch():
+        for name in names:
+            val = None
+            if isinstance(name, (list, tuple)):
+                name, val = name
+            set_option(name, val)
 
 def set_runtime_path(parts):
     rtp = ",".join(parts)
@@ -550,7 +1735,7 @@ def get_runtime_path():
     return rtp.split(",")
 
 def get_option(name):
-    value = vim.eval("&%s" % name)
+    value = _eval("&%s" % name)
     return value
 
 def set_option(name, value=None, local=False):
@@ -591,15 +1776,96 @@ def _parse_buffer_flags(flags):
         parsed[name] = k in flags
     return parsed
 
+class BufferInfo(object):
+    """ a lightweight record describing one buffer, as returned by
+    get_buffer_info() """
+
+    __slots__ = ("number", "name", "listed", "loaded", "hidden", "modified",
+            "readonly", "changedtick", "line_count", "windows", "current",
+            "alternate")
+
+    def __init__(self, raw, current, alternate):
+        (number, name, listed, loaded, hidden, modified, readonly, changedtick,
+                line_count, windows) = raw
+        self.number = int(number)
+        self.name = name
+        self.listed = bool(int(listed))
+        self.loaded = bool(int(loaded))
+        self.hidden = bool(int(hidden))
+        self.modified = bool(int(modified))
+        self.readonly = bool(int(readonly))
+        self.changedtick = int(changedtick)
+        # only vim 8.2+ knows the line count of buffers that aren't current
+        self.line_count = int(line_count)
+        if self.line_count < 0:
+            self.line_count = None
+        self.windows = [int(win) for win in windows]
+        self.current = self.number == current
+        self.alternate = self.number == alternate
+
+    def flags(self):
+        """ the flags in the same shape that get_buffers() has always
+        returned them """
+        return {
+            "unlisted": not self.listed,
+            "current": self.current,
+            "alternate": self.alternate,
+            "active": self.loaded and bool(self.windows),
+            "hidden": self.hidden,
+            "readonly": self.readonly,
+            "modified": self.modified,
+            # getbufinfo() doesn't tell us about read errors
+            "errors": False,
+        }
+
+    def as_dict(self):
+        return {
+            "name": self.name or "[No Name]",
+            "flags": self.flags(),
+        }
+
+    def __repr__(self):
+        return "<BufferInfo %d %r>" % (self.number, self.name)
+
+
+# the fields of getbufinfo() that we care about.  notably, we leave out
+# "variables", which can be huge
+_BUFFER_INFO_FIELDS = "[v:val.bufnr, bufname(v:val.bufnr), v:val.listed, \
+v:val.loaded, v:val.hidden, v:val.changed, \
+getbufvar(v:val.bufnr, \"&readonly\"), v:val.changedtick, \
+get(v:val, \"linecount\", -1), v:val.windows]"
+
+def get_buffer_info(listed=True, loaded=False, modified=False):
+    """ returns a list of BufferInfo records, one for each buffer, fetched from
+    vim all at once.  the arguments narrow down which buffers are returned.
+    needs vim 8+, for getbufinfo() """
+    options = []
+    if listed:
+        options.append("'buflisted': 1")
+    if loaded:
+        options.append("'bufloaded': 1")
+    if modified:
+        options.append("'bufmodified': 1")
+
+    current, alternate, raw = _eval("[bufnr('%%'), bufnr('#'), \
+map(getbufinfo({%s}), '%s')]" % (", ".join(options),
+        escape_string_sq(_BUFFER_INFO_FIELDS)))
+    current, alternate = int(current), int(alternate)
+    return [BufferInfo(info, current, alternate) for info in raw]
+
 def get_buffers():
     """ gets all the buffers and the data associated with them """
-    out = command("ls", capture=True)
-    match = _BUFFER_LIST_REGEX.findall(out)
+    if _has_function("getbufinfo"):
+        return dict((info.number, info.as_dict()) for info in
+                get_buffer_info())
+
+    # older vims have to parse the output of :ls
     buffers = {}
-    if match:
-        for (num, flags, name) in match:
-            num = int(num)
-            buffers[num] = {
+    for line in iter_command_output("ls"):
+        match = _BUFFER_LIST_REGEX.match(line)
+        if match:
+            num, flags, name = match.groups()
+            buffers[int(num)] = {
                 "name": name,
                 "flags": _parse_buffer_flags(flags)
             }
@@ -623,58 +1889,501 @@ def new_buffer(name, type=BUFFER_SCRATCH):
         buf = get_current_buffer()
     return buf
 
-@preserve_state()
+def _get_visual_lines(context):
+    """ returns the current buffer and the lines, as text, that a visual
+    selection covers """
+    b = _current_buffer()
+    lines = b[context.start[0] - 1:context.end[0]]
+    return b, [_to_text(line, context.encoding) for line in lines]
+
 def get_visual_selection():
-    keys("\<esc>gvy")
-    val = get_register("0")
-    return val
+    """ returns the contents of the current or last visual selection.  linewise
+    selections end in a newline, like yanking them would """
+    context = _get_visual_context()
+    if context is None:
+        return None
+    b, lines = _get_visual_lines(context)
+    spans = _visual_spans(lines, context)
+
+    if context.mode == _BLOCKWISE_VISUAL:
+        selected = "\n".join([_block_text(line, block, context.tabstop) for
+            line, block in zip(lines, spans)])
+    else:
+        selected = "\n".join([line[start:end] for line, (start, end) in
+            zip(lines, spans)])
+    if context.mode == "V" or _selects_newline(lines, context):
+        selected += "\n"
+    return _from_text(selected, context.encoding)
 
 def replace_visual_selection(rep):
-    with preserve_registers("a"):
-        set_register("a", rep)
-        keys("gvd")
-        if is_last_line() and False:
-            keys('"ap')
-        else:
-            keys('"aP')
+    """ replaces the contents of the current or last visual selection with rep.
+    afterwards, the '< and '> marks cover the new text, so "gv" reselects it """
+    context = _get_visual_context()
+    if context is None:
+        return
+    encoding = context.encoding
+    start_row = context.start[0]
+
+    # leave visual mode before we change the text out from under it
+    if context.active:
+        keys(r"\<esc>", keymaps=False)
+
+    b, lines = _get_visual_lines(context)
+    spans = _visual_spans(lines, context)
+
+    if not isinstance(rep, (type(""), bytes)):
+        rep = str(rep)
+    rep = _to_text(rep, encoding)
+
+    if context.mode == "V":
+        if rep.endswith("\n"):
+            rep = rep[:-1]
+        new_lines = rep.split("\n")
+        start_idx, end_row, end_idx = 0, len(new_lines) - 1, _MAXCOL
+
+    elif context.mode == _BLOCKWISE_VISUAL:
+        # each line of rep replaces the block on one row.  rows with no line of
+        # their own just have their block deleted, and any leftover lines of
+        # rep go on new lines underneath.  a tab or wide character on the edge
+        # of the block becomes spaces for its cells outside of it, so the rest
+        # of the line stays where it was
+        rep_lines = rep.split("\n")
+        rep_lines += [""] * (len(lines) - len(rep_lines))
+        new_lines = []
+        for line, (start, end, lead, trail), block in zip(lines, spans,
+                rep_lines):
+            new_lines.append(line[:start] + " " * lead + block + " " * trail +
+                    line[end:])
+        new_lines.extend(rep_lines[len(lines):])
+        start_idx = spans[0][0] + spans[0][2]
+        end_row = len(lines) - 1
+        end_idx = spans[-1][0] + spans[-1][2] + len(rep_lines[end_row]) - 1
 
-def set_buffer_contents(buf, s):
-    set_buffer_lines(buf, s.split("\n"))
+    else:
+        prefix = lines[0][:spans[0][0]]
+        suffix = lines[-1][spans[-1][1]:]
+        # the line break is replaced too, so the next line joins on, like it
+        # would with "gvd"
+        next_row = start_row - 1 + len(lines)
+        if _selects_newline(lines, context) and next_row < len(b):
+            suffix = _to_text(b[next_row], encoding)
+            lines.append(suffix)
+        new_lines = (prefix + rep + suffix).split("\n")
+        start_idx = len(prefix)
+        end_row = len(new_lines) - 1
+        end_idx = len(new_lines[-1]) - len(suffix) - 1
+
+    _set_lines(b, start_row - 1, start_row - 1 + len(lines),
+            [_from_text(line, encoding) for line in new_lines])
+
+    start_col = _index_to_byte_col(new_lines[0], start_idx, encoding) + 1
+    if end_idx == _MAXCOL:
+        end_col = _MAXCOL
+    else:
+        end_col = _index_to_byte_col(new_lines[end_row], max(end_idx, 0),
+                encoding) + 1
+    end_row += start_row
+    if (end_row, end_col) < (start_row, start_col):
+        end_row, end_col = start_row, start_col
+
+    cmd = "call setpos(\"'<\", [0, %d, %d, 0]) | " % (start_row, start_col)
+    cmd += "call setpos(\"'>\", [0, %d, %d, 0]) | " % (end_row, end_col)
+    cmd += "call cursor(%d, %d)" % (start_row, start_col)
+    command(cmd)
+
+def set_buffer_contents(buf, s, diff=False):
+    """ replaces the contents of buffer buf with the string s.  see
+    set_buffer_lines for diff """
+    return set_buffer_lines(buf, s.split("\n"), diff=diff)
 
-def set_buffer_lines(buf, l):
+def set_buffer_lines(buf, l, diff=False):
+    """ replaces the lines of buffer buf with the list l, and returns how many
+    lines were touched.  if diff is true, only the lines that actually changed
+    are written, which keeps marks, folds and undo history intact for the rest
+    of the buffer, and is much faster for small changes to big buffers """
     b = _get_buffer(buf)
-    b[:] = l
+    if not diff:
+        _set_lines(b, 0, len(b), l)
+        return len(l)
+    return _write_line_diff(b, list(b), list(l))
+
+# changed regions with no unique lines to anchor on are handed to difflib when
+# they're at most this many lines, and replaced whole otherwise.  past
+# _MAX_DIFF_HUNKS, one slice assignment is cheaper than many small ones
+_MAX_SMALL_DIFF = 200
+_MAX_DIFF_HUNKS = 100
+
+def _write_line_diff(b, old, new):
+    """ writes only the lines of new that differ from old into buffer object b,
+    one slice assignment per changed hunk.  returns the number of lines
+    touched """
+    hunks = _diff_hunks(old, new)
+    if len(hunks) > _MAX_DIFF_HUNKS:
+        hunks = [(hunks[0][0], hunks[-1][1], hunks[0][2], hunks[-1][3])]
+
+    # apply from the bottom up, so that earlier hunks' line numbers stay valid
+    touched = 0
+    for o1, o2, n1, n2 in reversed(hunks):
+        _set_lines(b, o1, o2, new[n1:n2])
+        touched += max(o2 - o1, n2 - n1)
+    return touched
+
+def _diff_hunks(old, new):
+    """ a patience diff of two lists of lines.  returns a sorted list of
+    (old_start, old_end, new_start, new_end) regions that differ.  lines that
+    appear exactly once on both sides anchor the diff, so it stays close to
+    linear on huge buffers, where difflib would take far too long """
+    hunks = []
+    regions = [(0, len(old), 0, len(new))]
+    while regions:
+        o1, o2, n1, n2 = regions.pop()
+
+        # most edits touch a small part of the buffer, so trimming the
+        # unchanged head and tail first leaves very little to diff
+        while o1 < o2 and n1 < n2 and old[o1] == new[n1]:
+            o1 += 1
+            n1 += 1
+        while o2 > o1 and n2 > n1 and old[o2 - 1] == new[n2 - 1]:
+            o2 -= 1
+            n2 -= 1
+
+        if o1 == o2 and n1 == n2:
+            continue
+        if o1 == o2 or n1 == n2:
+            hunks.append((o1, o2, n1, n2))
+            continue
+
+        anchors = _unique_anchors(old, o1, o2, new, n1, n2)
+        if anchors:
+            # the anchors themselves are equal, so we only need to diff the
+            # regions between them
+            prev_o, prev_n = o1, n1
+            for ao, an in anchors:
+                regions.append((prev_o, ao, prev_n, an))
+                prev_o, prev_n = ao + 1, an + 1
+            regions.append((prev_o, o2, prev_n, n2))
+
+        elif o2 - o1 == n2 - n1:
+            # same length, like a formatter rewriting lines in place, so we
+            # can pair the lines up directly
+            run_start = None
+            for k in range(o2 - o1 + 1):
+                differs = k < o2 - o1 and old[o1 + k] != new[n1 + k]
+                if differs and run_start is None:
+                    run_start = k
+                elif not differs and run_start is not None:
+                    hunks.append((o1 + run_start, o1 + k, n1 + run_start,
+                        n1 + k))
+                    run_start = None
+
+        elif (o2 - o1) + (n2 - n1) <= _MAX_SMALL_DIFF:
+            import difflib
+            matcher = difflib.SequenceMatcher(None, old[o1:o2], new[n1:n2],
+                    autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag != "equal":
+                    hunks.append((o1 + i1, o1 + i2, n1 + j1, n1 + j2))
+        else:
+            hunks.append((o1, o2, n1, n2))
+
+    hunks.sort()
+    return hunks
+
+def _unique_anchors(old, o1, o2, new, n1, n2):
+    """ finds the lines that appear exactly once in old[o1:o2] and exactly once
+    in new[n1:n2], and returns the longest run of their (old, new) index pairs
+    that is in the same order on both sides """
+    import bisect
+    # line -> [count in old, count in new, index in old, index in new]
+    seen = {}
+    for i in range(o1, o2):
+        entry = seen.get(old[i])
+        if entry is None:
+            seen[old[i]] = [1, 0, i, None]
+        else:
+            entry[0] += 1
+    for j in range(n1, n2):
+        entry = seen.get(new[j])
+        if entry is not None:
+            entry[1] += 1
+            entry[3] = j
+
+    pairs = sorted((entry[2], entry[3]) for entry in seen.values()
+            if entry[0] == 1 and entry[1] == 1)
+    if not pairs:
+        return []
+
+    # longest increasing subsequence of the new indices, by patience sorting
+    tails = []
+    tail_idx = []
+    back = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(k)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = k
+        back[k] = tail_idx[pos - 1] if pos else None
+
+    anchors = []
+    k = tail_idx[-1]
+    while k is not None:
+        anchors.append(pairs[k])
+        k = back[k]
+    anchors.reverse()
+    return anchors
 
 def get_current_buffer_contents():
     return get_buffer_contents(get_current_buffer())
 
-def get_buffer_contents(buf):
-    contents = "\n".join(get_buffer_lines(buf))
+def get_buffer_contents(buf, start=None, end=None):
+    """ returns the lines of buffer buf joined into a string.  start and end
+    work like get_buffer_lines """
+    if start is None and end is None and _buffer_cache is not None:
+        tick = _get_changedtick(buf)
+        if tick is not None:
+            key = (buf, tick, "contents")
+            contents = _buffer_cache.get(key)
+            if contents is None:
+                contents = "\n".join(_get_cached_lines(buf, tick,
+                    count=False))
+                _buffer_cache.put(key, contents, len(contents))
+            return contents
+
+    contents = "\n".join(get_buffer_lines(buf, start, end))
     return contents
 
-def get_buffer_lines(buf):
+def get_buffer_lines(buf, start=None, end=None):
+    """ returns a list of the lines of buffer buf.  start and end are 0-based
+    and work like a python slice, so only the lines you ask for are copied out
+    of vim """
+    if start is None and end is None and _buffer_cache is not None:
+        tick = _get_changedtick(buf)
+        if tick is not None:
+            # a copy, so that callers can't change what's in the cache
+            return list(_get_cached_lines(buf, tick))
+
     b = _get_buffer(buf)
-    return list(b)
+    if start is None and end is None:
+        return list(b)
+    return b[start:end]
+
+def _get_changedtick(buf):
+    """ returns the changedtick of buffer buf, or None if there's no such
+    buffer """
+    tick = _eval("getbufvar(%d, 'changedtick')" % buf)
+    if tick == "":
+        return None
+    return int(tick)
+
+def _get_cached_lines(buf, tick, count=True):
+    """ the lines of buf at changedtick tick, from the cache if they're there.
+    without count, the lookup isn't counted in the cache's stats, for reads
+    that have already been counted """
+    key = (buf, tick, "lines")
+    lines = _buffer_cache.get(key, count)
+    if lines is None:
+        lines = list(_get_buffer(buf))
+        size = sum(len(line) for line in lines) + 8 * len(lines)
+        _buffer_cache.put(key, lines, size)
+    return lines
+
+
+class _BufferCache(object):
+    """ a least-recently-used cache of buffer contents, keyed on
+    (buffer, changedtick, kind).  vim bumps a buffer's changedtick on every
+    change, so an entry can never be out of date """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            if count:
+                self.misses += 1
+            return None
+        # re-inserting marks it as the most recently used
+        self.entries[key] = (value, size)
+        if count:
+            self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+
+        # older versions of this buffer can never be hit again
+        buf, tick, _ = key
+        for old_key in list(self.entries):
+            if old_key[0] == buf and old_key[1] != tick:
+                self._remove(old_key)
+
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (value, size)
+        self.size += size
+        self.shrink()
+
+    def shrink(self):
+        """ evicts the least recently used entries until we fit in max_bytes """
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+_buffer_cache = None
+
+def enable_buffer_cache(max_bytes=64 * 1024 * 1024):
+    """ turns on caching of get_buffer_lines(buf) and get_buffer_contents(buf),
+    for whole-buffer reads.  as long as a buffer hasn't changed, reading it
+    again doesn't copy it out of vim.  the cache holds about max_bytes of text,
+    evicting the least recently used buffers first """
+    global _buffer_cache
+    if _buffer_cache is None:
+        _buffer_cache = _BufferCache(max_bytes)
+    else:
+        _buffer_cache.max_bytes = max_bytes
+        _buffer_cache.shrink()
+
+def disable_buffer_cache():
+    """ turns off the buffer cache and frees everything in it """
+    global _buffer_cache
+    _buffer_cache = None
+
+def buffer_cache_stats():
+    """ returns a dictionary of hits, misses, evictions, entries and bytes for
+    the buffer cache, or None if it isn't enabled """
+    if _buffer_cache is None:
+        return None
+    return _buffer_cache.stats()
+
+def iter_buffer_lines(buf, start=0, end=None, chunk_size=1000):
+    """ lazily yields the lines of buffer buf, copying them out of vim
+    chunk_size lines at a time, so scanning a huge buffer only ever holds one
+    chunk in memory """
+    while end is None or start < end:
+        stop = start + chunk_size
+        if end is not None:
+            stop = min(stop, end)
+        # we look the buffer up for every chunk, in case it was wiped while
+        # we were iterating
+        chunk = _get_buffer(buf)[start:stop]
+        for line in chunk:
+            yield line
+        if len(chunk) < stop - start:
+            break
+        start = stop
+
+class BufferView(object):
+    """ a read-only, list-like view of a buffer's lines.  nothing is copied out
+    of vim until you index, slice or iterate it, and then only the lines you
+    asked for:
+
+        view = BufferView(get_current_buffer())
+        first_ten = view[:10]
+        for line in view:
+            pass
+    """
+
+    __slots__ = ("buf", "chunk_size")
+
+    def __init__(self, buf, chunk_size=1000):
+        self.buf = buf
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(_get_buffer(self.buf))
+
+    def __getitem__(self, key):
+        return _get_buffer(self.buf)[key]
+
+    def __iter__(self):
+        return iter_buffer_lines(self.buf, chunk_size=self.chunk_size)
+
+    def __repr__(self):
+        return "<BufferView %d>" % self.buf
 
 def raw_input(prompt=""):
     """ designed to shadow python's raw_input function, because it behaves the
     same way, except in vim """
     command("call inputsave()")
-    stuff = vim.eval("input('%s')" % escape_string_sq(prompt))
+    stuff = _eval("input('%s')" % escape_string_sq(prompt))
     command("call inputrestore()")
     return stuff
 
 def multi_command(*cmds):
     """  convenience function for setting multiple commands at once in your
     .vimpy.rc, like "syntax on", "nohlsearch", etc """
-    for cmd in cmds:
-        command(cmd)
+    with batch():
+        for cmd in cmds:
+            command(cmd)
 
 
 class AutoCommandContext(object):
     """ an object of this class is passed to functions decorated with one of our
     autocommand decorators.  its purpose is to give the decorated function
-    access to buffer-local versions of our helper functions """
+    access to buffer-local versions of our helper functions.  the decorated
+    function runs inside of a batch(), so all of the commands issued through
+    these helpers reach vim together.  it also carries what vim knew about the
+    event when it fired: event, bufnr, changedtick, file (<afile>) and match
+    (<amatch>), so handlers don't need to ask vim for them """
+
+    # how many events this call stands for.  more than 1 when on_autocmd was
+    # given debounce or throttle
+    event_count = 1
+
+    def __init__(self, event=None, bufnr=None, changedtick=None, file=None,
+            match=None):
+        self.event = event
+        self.bufnr = bufnr
+        self.changedtick = changedtick
+        self.file = file
+        self.match = match
+        self._filetype = None
+        self._v_event = None
+
+    @property
+    def filetype(self):
+        """ the filetype of the event's buffer.  free for FileType events,
+        otherwise fetched from vim the first time it's used """
+        if self._filetype is None:
+            if self.event == "FileType":
+                self._filetype = self.match
+            else:
+                self._filetype = _eval("getbufvar(%d, '&filetype')" %
+                        self.bufnr)
+        return self._filetype
+
+    @property
+    def v_event(self):
+        """ vim's v:event for the event, fetched the first time it's used.  it
+        only exists while the event is being handled, so it's empty for
+        handlers that are debounced or throttled """
+        if self._v_event is None:
+            self._v_event = _eval("v:event")
+        return self._v_event
 
     def abbrev(self, *args, **kwargs):
         fn = partial(abbrev, local=True)
@@ -697,21 +2406,174 @@ class AutoCommandContext(object):
         return fn(*args, **kwargs)
 
 
-def on_autocmd(event, filetype):
+def subscribe(event, pattern, fn, key=None):
+    """ calls fn(ctx) whenever the autocommand event fires for pattern.  all of
+    the handlers for the same event and pattern share a single autocommand, and
+    run in the order they were first subscribed, inside one batch().  an error
+    in one handler is reported without stopping the rest.  subscribing again
+    with the same key replaces the handler, keeping its place.  the key
+    defaults to where fn was defined, and is returned for unsubscribe() """
+    if key is None:
+        key = _definition_site(fn)
+    pair = (event, pattern)
+    handlers = _event_subscribers.get(pair)
+    if handlers is None:
+        handlers = _event_subscribers[pair] = OrderedDict()
+        reg_key = "autocmd %s %s" % pair
+        register_fn(partial(_dispatch_event, pair), key=reg_key)
+        handle = _registry_handle(reg_key, None)
+        # clearing the pair first means reloading snake doesn't leave a
+        # duplicate autocommand behind
+        with batch():
+            command("augroup snake_events")
+            command("autocmd! %s %s" % pair)
+            command("autocmd %s %s call SnakeAutocmd('%s', '%s', '%s')" %
+                    (event, pattern, PYTHON_CMD, handle, event))
+            command("augroup END")
+    handlers[key] = fn
+    return key
+
+def unsubscribe(event, pattern, key):
+    """ removes a handler added with subscribe().  returns whether there was
+    one to remove """
+    pair = (event, pattern)
+    handlers = _event_subscribers.get(pair)
+    if handlers is None or handlers.pop(key, None) is None:
+        return False
+    if not handlers:
+        del _event_subscribers[pair]
+        unregister_fn("autocmd %s %s" % pair)
+        command("autocmd! snake_events %s %s" % pair)
+    return True
+
+def _dispatch_event(pair, ctx):
+    """ runs every handler subscribed to an event and pattern.  each handler's
+    commands are batched and flushed on their own, so a command that fails in
+    vim is reported as that handler's error, and the other handlers' commands
+    still run """
+    for key, fn in list(_event_subscribers.get(pair, {}).items()):
+        try:
+            with batch():
+                _call_registered("%s %s: %s" % (pair + (key,)), fn, ctx)
+        except Exception:
+            _report_exception("Error in %s handler %s:" % (ctx.event, key))
+
+# (event, pattern) -> {key: handler}, in the order they were subscribed
+_event_subscribers = {}
+
+
+class _EventLimiter(object):
+    """ collapses bursts of autocommand events into fewer calls of fn, using
+    vim timers.  with debounce, fn is called once the events have stopped for
+    debounce ms.  with throttle, fn is called on the first event and then at
+    most once every throttle ms.  either way, fn is passed the context of the
+    last event, with its event_count set to how many events were merged """
+
+    def __init__(self, fn, debounce=None, throttle=None):
+        self.fn = fn
+        self.name = "deferred: %s" % _definition_site(fn)
+        self.debounce = debounce
+        self.throttle = throttle
+        self.timer = None
+        self.ctx = None
+        self.count = 0
+        self.last_event = 0
+
+    def __call__(self, ctx):
+        self.ctx = ctx
+        self.count += 1
+        self.last_event = time.time()
+
+        # while a timer is pending, an event costs us nothing but the above
+        if self.timer is not None:
+            return
+
+        if self.debounce is not None:
+            self.timer = _start_timer(self.debounce, self._on_debounce)
+        else:
+            self._fire()
+            self.timer = _start_timer(self.throttle, self._on_throttle)
+
+    def _on_debounce(self):
+        self.timer = None
+        remaining = self.last_event + self.debounce / 1000.0 - time.time()
+        if remaining > 0:
+            self.timer = _start_timer(int(remaining * 1000) + 1,
+                    self._on_debounce)
+        else:
+            self._fire()
+
+    def _on_throttle(self):
+        self.timer = None
+        if self.count:
+            self._fire()
+            self.timer = _start_timer(self.throttle, self._on_throttle)
+
+    def _fire(self):
+        import copy
+        # the context is shared with the event's other handlers
+        ctx = copy.copy(self.ctx)
+        ctx.event_count = self.count
+        self.ctx = None
+        self.count = 0
+
+        # from a timer, another buffer may be current by now.  buffer-local
+        # helpers act on the current buffer, so the handler runs in the
+        # event's buffer, or not at all if that buffer is gone
+        current = buf = ctx.bufnr
+        if buf is not None:
+            current, exists = [int(v) for v in
+                    _eval("[bufnr('%%'), bufexists(%d)]" % buf)]
+            if not exists:
+                return
+
+        with batch():
+            if buf != current:
+                _switch_buffer(buf)
+            try:
+                _call_registered(self.name, self.fn, ctx)
+            finally:
+                if buf != current:
+                    _switch_buffer(current)
+
+def _switch_buffer(buf):
+    """ makes buf current for a moment, without leaving a trace: the buffer we
+    leave is hidden even if it's modified, no autocommands fire, and the
+    alternate file is untouched """
+    command("noautocmd keepalt buffer! %d" % buf)
+
+
+def on_autocmd(event, filetype, debounce=None, throttle=None):
     """ A decorator for functions to trigger on AutoCommand events.
     Your function will be passed an instance of
     AutoCommandContext, which contains on it *buffer-local* methods that would
     be useful to you. A filetype of "*" matches all files.
     For a list of eligible events, try :help autocmd-events in vim.  
+
+    For events that fire often, like TextChanged or CursorMoved, pass
+    debounce=ms to only run your function once the events have stopped for
+    that long, or throttle=ms to run it at most once every ms.  Your function
+    then runs later, from a timer, and ctx.event_count says how many events
+    were merged into the call.
     """ 
+    if debounce is not None and throttle is not None:
+        raise ValueError("Only one of debounce and throttle can be used")
+    if (debounce is not None or throttle is not None) and \
+            not _has_feature("timers"):
+        raise Exception("debounce and throttle need a Vim compiled with \
++timers")
+
+    @_startup_timed(lambda fn: "on_autocmd %s %s" % (event, filetype))
     def wrapped(fn):
-        au_name = _generate_autocommand_name(fn)
-        command("augroup %s" % au_name)
-        command("autocmd!")
-        ctx = AutoCommandContext()
-        call = register_fn(partial(fn, ctx))
-        command("autocmd %s %s :%s %s" % (event, filetype, PYTHON_CMD, call))
-        command("augroup END")
+        if debounce is not None or throttle is not None:
+            call_fn = _EventLimiter(fn, debounce, throttle)
+        else:
+            call_fn = fn
+
+        key = _definition_site(fn)
+        with batch():
+            for name in event.split(","):
+                subscribe(name, filetype, call_fn, key=key)
         return fn
 
     return wrapped
@@ -728,7 +2590,375 @@ def set_filetype(pat, ftype):
     command(s)
 
 
-if "snake.plugin_loader" in sys.modules:
-    plugin_loader = reload(plugin_loader)
-else:
-    from . import plugin_loader
+def _report_exception(msg):
+    """ shows the exception currently being handled as an error message,
+    without interrupting whatever we were doing """
+    import traceback
+    lines = [msg] + traceback.format_exc().rstrip().split("\n")
+    with batch():
+        command("echohl ErrorMsg")
+        for line in lines:
+            command("echom '%s'" % escape_string_sq(line))
+        command("echohl None")
+
+
+def _start_timer(ms, fn, repeat=False):
+    """ calls fn on vim's main thread after ms milliseconds, using a vim timer
+    that calls SnakeTimer() from prelude.vim.  returns the timer's id """
+    if not _has_feature("timers"):
+        raise Exception("This needs a Vim compiled with +timers")
+    options = "{'repeat': -1}" if repeat else "{}"
+    timer = int(_eval("timer_start(%d, function('SnakeTimer', ['%s']), %s)" %
+        (ms, PYTHON_CMD, options)))
+    _timers[timer] = (fn, repeat)
+    return timer
+
+def _stop_timer(timer):
+    _timers.pop(timer, None)
+    command("call timer_stop(%d)" % timer)
+
+def _on_timer(timer):
+    """ called by SnakeTimer() when one of our timers fires """
+    try:
+        fn, repeat = _timers[timer]
+    except KeyError:
+        # the timer was started before snake was reloaded, so nothing knows
+        # about it anymore
+        command("call timer_stop(%d)" % timer)
+        return
+
+    if not repeat:
+        del _timers[timer]
+    fn()
+
+# timer id -> (callback, repeats)
+_timers = {}
+
+
+# settings for run_async.  they take effect the first time it is called
+ASYNC_MAX_WORKERS = 4
+ASYNC_MAX_IN_FLIGHT = 32
+ASYNC_POLL_MS = 20
+
+class AsyncTask(object):
+    """ a handle to a function running in the background, returned by
+    run_async() """
+
+    __slots__ = ("future", "callback", "error_callback", "key", "cancelled")
+
+    def __init__(self, callback, error_callback, key):
+        self.future = None
+        self.callback = callback
+        self.error_callback = error_callback
+        self.key = key
+        self.cancelled = False
+
+    def cancel(self):
+        """ stops the task if it hasn't started yet.  either way, its callbacks
+        won't be called """
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+        _forget_async_task(self)
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+def _get_async_pool():
+    global _async_pool
+    if _async_pool is None:
+        try:
+            from concurrent import futures
+        except ImportError:
+            raise Exception("run_async needs concurrent.futures.  On Python 2, \
+install the \"futures\" package.")
+        _async_pool = futures.ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS)
+    return _async_pool
+
+def run_async(fn, *args, **kwargs):
+    """ runs fn(*args) on a background thread, so slow work doesn't freeze vim.
+    the vim module can't be used from other threads, so fn shouldn't touch
+    snake or vim.  when fn finishes, callback(result) is called on vim's main
+    thread, where it can use snake as usual.  if fn raises, error_callback(exc)
+    is called instead, or the error is shown in vim.
+
+    if key is given, for example a buffer number, starting a new task with the
+    same key cancels the old one, so only the latest result is delivered.
+    returns an AsyncTask, which can be cancelled """
+    callback = kwargs.pop("callback", None)
+    error_callback = kwargs.pop("error_callback", None)
+    key = kwargs.pop("key", None)
+    if kwargs:
+        raise TypeError("unexpected keyword arguments: %s" %
+                ", ".join(sorted(kwargs)))
+
+    if key is not None and key in _async_latest:
+        _async_latest[key].cancel()
+
+    if len(_async_tasks) >= ASYNC_MAX_IN_FLIGHT:
+        raise Exception("Too many tasks running in the background (%d).  \
+Increase snake.ASYNC_MAX_IN_FLIGHT if you really need more." %
+            len(_async_tasks))
+
+    task = AsyncTask(callback, error_callback, key)
+    task.future = _get_async_pool().submit(fn, *args)
+    _async_tasks.add(task)
+    if key is not None:
+        _async_latest[key] = task
+
+    # this runs on the worker thread, so all it may do is hand the task back
+    # to the main thread
+    task.future.add_done_callback(lambda _: _async_results.append(task))
+
+    global _async_poll_timer
+    if _async_poll_timer is None:
+        _async_poll_timer = _start_timer(ASYNC_POLL_MS, _poll_async,
+                repeat=True)
+    return task
+
+def _forget_async_task(task):
+    _async_tasks.discard(task)
+    if task.key is not None and _async_latest.get(task.key) is task:
+        del _async_latest[task.key]
+
+def _poll_async():
+    """ delivers the results of finished tasks, on the main thread """
+    global _async_poll_timer
+    while _async_results:
+        task = _async_results.popleft()
+        _forget_async_task(task)
+        if task.cancelled or task.future.cancelled():
+            continue
+
+        error = task.future.exception()
+        try:
+            if error is None:
+                if task.callback is not None:
+                    task.callback(task.future.result())
+            elif task.error_callback is not None:
+                task.error_callback(error)
+            else:
+                raise error
+        except Exception:
+            _report_exception("Error in background task:")
+
+    if not _async_tasks and _async_poll_timer is not None:
+        _stop_timer(_async_poll_timer)
+        _async_poll_timer = None
+
+_async_pool = None
+_async_poll_timer = None
+_async_tasks = set()
+# key -> the latest AsyncTask started with that key
+_async_latest = {}
+# finished tasks, handed over from the worker threads.  appending and popping
+# from either end of a deque is thread safe
+_async_results = deque()
+
+
+# how long each slice of spawn()ed work may run for, and how often slices run
+SCHEDULER_SLICE_MS = 8
+SCHEDULER_INTERVAL_MS = 10
+
+class ScheduledTask(object):
+    """ a generator being run a little at a time by spawn() """
+
+    __slots__ = ("gen", "name", "priority", "buffer", "cancel_on_change",
+            "changedtick", "progress", "on_done", "show_progress", "cancelled",
+            "finished", "result", "order", "running")
+
+    def __init__(self, gen, name, priority, buffer, cancel_on_change,
+            on_done, show_progress, order):
+        self.gen = gen
+        self.name = name
+        self.priority = priority
+        self.buffer = buffer
+        self.cancel_on_change = cancel_on_change
+        self.changedtick = None
+        self.progress = None
+        self.on_done = on_done
+        self.show_progress = show_progress
+        self.cancelled = False
+        self.finished = False
+        self.result = None
+        self.order = order
+        self.running = False
+
+    def cancel(self):
+        """ stops the task.  its generator is closed, so any finally blocks in
+        it run """
+        if self.finished:
+            return
+        self.cancelled = True
+        self.finished = True
+        _forget_scheduled_task(self)
+        # a running generator can't be closed, so a task that cancels itself
+        # is closed by _step_task once it yields
+        if not self.running:
+            self.gen.close()
+
+    def __repr__(self):
+        return "<ScheduledTask %s priority=%d progress=%r>" % (self.name,
+                self.priority, self.progress)
+
+def spawn(gen, priority=0, buffer=None, cancel_on_change=False, on_done=None,
+        name=None, show_progress=False):
+    """ runs the generator gen a little at a time, from a vim timer, so long
+    jobs that need the vim module don't freeze vim.  gen should yield often;
+    each time it does, we check whether its time slice is used up.  it can
+    yield a number from 0 to 1 to report its progress, which is kept on the
+    task and, with show_progress, echoed.
+
+    tasks with a higher priority run first.  if buffer is given, the task is
+    cancelled when that buffer is wiped out, and with cancel_on_change, when
+    anything other than the task changes it.  on_done(result) is called when
+    the generator finishes, with its return value on python 3.  returns a
+    ScheduledTask, which can be cancelled """
+    global _scheduler_counter, _scheduler_timer
+    _scheduler_counter += 1
+    if name is None:
+        name = getattr(gen, "__name__", "task")
+    task = ScheduledTask(gen, name, priority, buffer, cancel_on_change,
+            on_done, show_progress, _scheduler_counter)
+
+    if buffer is not None:
+        task.changedtick = _get_changedtick(buffer)
+        if task.changedtick is None:
+            raise Exception("Buffer %d doesn't exist" % buffer)
+
+    _scheduled_tasks.append(task)
+    if _scheduler_timer is None:
+        _scheduler_timer = _start_timer(SCHEDULER_INTERVAL_MS,
+                _run_scheduler_slice, repeat=True)
+    return task
+
+def get_scheduled_tasks():
+    """ returns the ScheduledTasks that haven't finished yet """
+    return list(_scheduled_tasks)
+
+def _buffer_changedticks(tasks):
+    """ returns {buffer: changedtick} for the buffers that tasks are watching,
+    with a changedtick of None for buffers that are gone """
+    bufs = sorted(set(t.buffer for t in tasks if t.buffer is not None))
+    if not bufs:
+        return {}
+    ticks = _eval("map(%s, 'getbufvar(v:val, \"changedtick\")')" % bufs)
+    return dict((buf, int(tick) if tick != "" else None) for buf, tick in
+            zip(bufs, ticks))
+
+def _run_scheduler_slice():
+    """ called by our timer.  runs the highest priority tasks, round robin,
+    until the slice's time is up """
+    global _scheduler_timer
+    deadline = time.time() + SCHEDULER_SLICE_MS / 1000.0
+
+    ticks = _buffer_changedticks(_scheduled_tasks)
+    for task in list(_scheduled_tasks):
+        if task.buffer is None:
+            continue
+        tick = ticks[task.buffer]
+        if tick is None or (task.cancel_on_change and
+                tick != task.changedtick):
+            task.cancel()
+
+    if _scheduled_tasks:
+        top = max(task.priority for task in _scheduled_tasks)
+        running = sorted((task for task in _scheduled_tasks
+            if task.priority == top), key=lambda task: task.order)
+
+        while running and time.time() < deadline:
+            for task in list(running):
+                # another task may have cancelled it
+                if task.finished or not _step_task(task):
+                    running.remove(task)
+                if time.time() >= deadline:
+                    break
+
+        # the tasks may have changed their own buffers, which shouldn't
+        # cancel them
+        watching = [t for t in _scheduled_tasks if t.cancel_on_change and
+                t.buffer is not None]
+        if watching:
+            ticks = _buffer_changedticks(watching)
+            for task in watching:
+                task.changedtick = ticks[task.buffer]
+
+    progress = [t for t in _scheduled_tasks if t.show_progress and
+            t.progress is not None]
+    if progress:
+        debug("  ".join("%s: %d%%" % (t.name, t.progress * 100) for t in
+            progress))
+
+    if not _scheduled_tasks and _scheduler_timer is not None:
+        _stop_timer(_scheduler_timer)
+        _scheduler_timer = None
+
+def _step_task(task):
+    """ advances task by one yield.  returns whether it can keep going """
+    task.running = True
+    try:
+        progress = next(task.gen)
+    except StopIteration as e:
+        task.running = False
+        if task.cancelled:
+            return False
+        task.finished = True
+        task.result = getattr(e, "value", None)
+        _forget_scheduled_task(task)
+        if task.show_progress:
+            debug("%s: done" % task.name)
+        if task.on_done is not None:
+            try:
+                task.on_done(task.result)
+            except Exception:
+                _report_exception("Error in on_done for task %s:" % task.name)
+        return False
+    except Exception:
+        task.running = False
+        if task.cancelled:
+            return False
+        task.finished = True
+        _forget_scheduled_task(task)
+        _report_exception("Error in task %s:" % task.name)
+        return False
+
+    task.running = False
+    # it cancelled itself
+    if task.cancelled:
+        task.gen.close()
+        return False
+
+    if isinstance(progress, (int, float)) and not isinstance(progress, bool):
+        task.progress = max(0.0, min(1.0, float(progress)))
+    return True
+
+def _forget_scheduled_task(task):
+    if task in _scheduled_tasks:
+        _scheduled_tasks.remove(task)
+
+_scheduled_tasks = []
+_scheduler_counter = 0
+_scheduler_timer = None
+
+
+# kept for plugins and vimrcs that use them.  they're fetched together, in one
+# call into vim, which also fills in the caches the rest of snake uses
+_vim_version, _has_pyeval = [int(v) for v in
+        _eval("[v:version, exists('*pyeval')]")]
+_vim_functions["pyeval"] = bool(_has_pyeval)
+VERSION = _vim_version
+PYEVAL = _get_pyeval()
+
+
+if _startup_profile is not None:
+    _startup_profile.append(("import snake",
+        (time.time() - _import_start) * 1000))
+
+# this is what loads ~/.vimrc.py
+with _startup_phase("load plugin_loader"):
+    if "snake.plugin_loader" in sys.modules:
+        plugin_loader = reload(plugin_loader)
+    else:
+        from . import plugin_loader
+
+_finish_startup_profile()
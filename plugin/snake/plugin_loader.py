@@ -1,9 +1,9 @@
 import imp
+import re
 import sys
 import os
 from os.path import expanduser, exists, abspath, join, dirname
 from contextlib import contextmanager
-import subprocess
 import logging
 import snake
 
@@ -12,16 +12,13 @@ log = logging.getLogger("snake.plugins")
 
 
 # virtualenv may not exist, but we also may not need it if the user is just
-# running scripts that have no dependencies outside of the stdlib
-try:
-    import pip
-except ImportError:
-    pip = None
-
-try:
-    import virtualenv
-except ImportError:
-    virtualenv = None
+# running scripts that have no dependencies outside of the stdlib.  importing
+# pip is slow, so we only look for them when a plugin needs a virtualenv
+def _import_optional(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
 
 # let's use our virtualenv_wrapper home if we have one, else default to
 # something sensible.  we'll use this to create our new virtualenvs for plugins
@@ -37,33 +34,273 @@ if IS_PY3:
         exec(open(name).read(), ctx)
 
 
+# the python the virtualenvs are made for, which has to be the one vim runs
+PYTHON_VERSION = "%d.%d" % sys.version_info[:2]
+# written into each virtualenv, so we can tell what it was made for
+VENV_MANIFEST = "snake-requirements.txt"
+# holds an empty file for each plugin using a virtualenv
+VENV_PLUGINS_DIR = "snake-plugins"
+
+_REQ_COMMENT_REGEX = re.compile(r"(^|\s)#.*$")
+_REQ_INCLUDE_REGEX = re.compile(r"^(-r|--requirement)[\s=]+(.+)$")
+_REQ_NAME_REGEX = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$")
+
+
 def venv_exists(plugin_name):
     return exists(join(VENV_BASE_DIR, plugin_name))
 
+def read_requirements(reqs_file):
+    """ the requirements in a requirements file, normalised so that files that
+    ask for the same things read the same: without comments, blank lines or
+    spaces, with project names in their canonical form, sorted, and with any
+    files they include with -r inlined """
+    reqs = set()
+    with open(reqs_file) as h:
+        for line in h:
+            line = _REQ_COMMENT_REGEX.sub("", line).strip()
+            if not line:
+                continue
+
+            include = _REQ_INCLUDE_REGEX.match(line)
+            if include:
+                path = join(dirname(reqs_file), include.group(2).strip())
+                reqs.update(read_requirements(path))
+                continue
+
+            line = "".join(line.split())
+            name = _REQ_NAME_REGEX.match(line)
+            if name:
+                line = re.sub(r"[-_.]+", "-", name.group(1)).lower() + \
+                        name.group(2)
+            reqs.add(line)
+    return sorted(reqs)
+
+def _venv_manifest(reqs):
+    return "\n".join(["# python %s" % PYTHON_VERSION] + reqs) + "\n"
+
+def venv_name_for_requirements(reqs):
+    """ the virtualenv for a list of normalised requirements.  it's named
+    after their hash, and the python version, so plugins that need the same
+    things share one """
+    import hashlib
+    digest = hashlib.sha1(_venv_manifest(reqs).encode("utf8")).hexdigest()
+    return "snake_env_%s" % digest[:16]
+
+def venv_is_current(name, reqs):
+    """ whether the virtualenv name was made for reqs """
+    try:
+        with open(join(VENV_BASE_DIR, name, VENV_MANIFEST)) as h:
+            return h.read() == _venv_manifest(reqs)
+    except (IOError, OSError):
+        return False
+
+def claim_venv(plugin_name, venv_name):
+    """ records that plugin_name uses the virtualenv venv_name.  virtualenvs the
+    plugin used before, for older requirements, are deleted once no plugin is
+    using them """
+    import shutil
+    marker = join(VENV_BASE_DIR, venv_name, VENV_PLUGINS_DIR, plugin_name)
+    if exists(marker) or not venv_exists(venv_name):
+        return
+
+    for name in os.listdir(VENV_BASE_DIR):
+        plugins_dir = join(VENV_BASE_DIR, name, VENV_PLUGINS_DIR)
+        old_marker = join(plugins_dir, plugin_name)
+        if name == venv_name or not exists(old_marker):
+            continue
+        os.remove(old_marker)
+        if not os.listdir(plugins_dir):
+            shutil.rmtree(join(VENV_BASE_DIR, name), ignore_errors=True)
+
+    if not exists(dirname(marker)):
+        os.makedirs(dirname(marker))
+    open(marker, "w").close()
+
+def _run_quietly(args):
+    """ runs a command without letting it write over vim's screen.  returns its
+    exit code and what it wrote to stderr """
+    import subprocess
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(args, stdout=devnull, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+    return proc.returncode, err.decode("utf8", "replace")
+
 def pip_install(reqs_file, install_dir):
     """ takes a requirements file and installs all the reqs in that file into
-    the virtualenv """
-    args = ["pip", "install", "--quiet", "-t", install_dir, "-r", reqs_file]
-    exit_code = subprocess.call(args)
+    the virtualenv.  packages are installed from our wheel cache, which every
+    plugin shares, so only the ones that no plugin has needed before are
+    downloaded """
+    try:
+        os.makedirs(WHEEL_DIR)
+    except OSError:
+        pass
 
-    # we have to specify --system sometimes on ubuntu, because ubuntu can ship
-    # with an older pip which defaults to --user, which conflicts with -t.
-    # --system effectively disables --user (ugly workaround)
+    offline = ["pip", "install", "--quiet", "-t", install_dir, "--no-index",
+            "--find-links", WHEEL_DIR, "-r", reqs_file]
+    exit_code, err = _run_quietly(offline)
+    if exit_code != 0:
+        # download and build whatever the cache is missing, then try again
+        exit_code, err = _run_quietly(["pip", "wheel", "--quiet",
+            "--wheel-dir", WHEEL_DIR, "--find-links", WHEEL_DIR, "-r",
+            reqs_file])
+        if exit_code == 0:
+            exit_code, err = _run_quietly(offline)
+
+    # some packages can't be built into wheels, so fall back to installing
+    # straight from the index
     if exit_code != 0:
-        args.append("--system")
-        exit_code = subprocess.call(args)
+        args = ["pip", "install", "--quiet", "-t", install_dir, "-r", reqs_file]
+        exit_code, err = _run_quietly(args)
 
+        # we have to specify --system sometimes on ubuntu, because ubuntu can
+        # ship with an older pip which defaults to --user, which conflicts with
+        # -t.  --system effectively disables --user (ugly workaround)
+        if exit_code != 0:
+            args.append("--system")
+            exit_code, err = _run_quietly(args)
+
+    if exit_code != 0:
+        raise Exception("Couldn't install %s:\n%s" % (reqs_file, err.strip()))
 
-def venv_name_from_module_name(name):
-    return "snake_plugin_%s" % name
 
 def new_venv(name):
     home_dir = join(VENV_BASE_DIR, name)
-    virtualenv.create_environment(home_dir)
+    exit_code, err = _run_quietly(["virtualenv", "--quiet", "--python",
+        "python" + PYTHON_VERSION, home_dir])
+    if exit_code != 0:
+        raise Exception("Couldn't create virtualenv %s:\n%s" % (name,
+            err.strip()))
+    return home_dir
+
+def provision_venv(name, reqs_file):
+    """ creates the virtualenv name and installs reqs_file into it.  it's built
+    to the side and moved into place once it's done, so a vim starting in the
+    meantime, or an install that fails, never finds half of one.  the packages
+    that were installed before, for older requirements, come from the wheel
+    cache, so only what changed is downloaded """
+    import shutil
+    home_dir = join(VENV_BASE_DIR, name)
+    partial = new_venv("%s.partial-%d" % (name, os.getpid()))
+    try:
+        pip_install(reqs_file, find_site_packages(partial))
+        with open(join(partial, VENV_MANIFEST), "w") as h:
+            h.write(_venv_manifest(read_requirements(reqs_file)))
+        os.rename(partial, home_dir)
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        # another vim got there first
+        if venv_exists(name):
+            return home_dir
+        raise
     return home_dir
 
 def find_site_packages(venv_dir):
-    return join(venv_dir, "lib", "python%s" % sys.version[:3], "site-packages")
+    return join(venv_dir, "lib", "python" + PYTHON_VERSION, "site-packages")
+
+
+# with timers, plugins' virtualenvs are created and their requirements
+# installed in the background, several at a time, instead of freezing vim
+# until they're done.  SNAKE_BACKGROUND_VENVS=0 goes back to doing it during
+# the import
+background_venvs = bool(int(os.environ.get("SNAKE_BACKGROUND_VENVS", "1")))
+
+# plugin name -> the AsyncTask provisioning its virtualenv
+_provisioning = {}
+# virtualenv name -> (the AsyncTask provisioning it, [(ready, failed)] for each
+# plugin waiting on it)
+_venv_tasks = {}
+
+
+def _can_provision_in_background():
+    if not background_venvs or not snake._has_feature("timers"):
+        return False
+    try:
+        snake._get_async_pool()
+    except Exception:
+        return False
+    return True
+
+def _show_provisioning(ready=None):
+    """ shows which plugins are still having their requirements installed """
+    msg = []
+    if ready is not None:
+        msg.append("Plugin %s is ready." % ready)
+    if _provisioning:
+        msg.append("Installing requirements for %s..." %
+                ", ".join(sorted(_provisioning)))
+    snake.debug("  ".join(msg))
+
+def _load_plugin(fullname, found, venv_name=None):
+    """ runs a plugin's module, inside its virtualenv if it has one.  found is
+    what imp.find_module returned for it """
+    if venv_name is not None and venv_exists(venv_name):
+        with in_virtualenv(venv_name):
+            mod = imp.load_module(fullname, *found)
+            mod.__virtualenv__ = venv_name
+    else:
+        mod = imp.load_module(fullname, *found)
+    return mod
+
+def _load_when_provisioned(loader, fullname, plugin_name, venv_name, reqs,
+        found):
+    """ starts provisioning a plugin's virtualenv in the background, and
+    returns an empty module for the plugin.  once the virtualenv is ready, the
+    plugin runs inside that same module, so its key maps and autocommands take
+    effect then, and whatever imported it sees its contents """
+    pathname = found[1]
+    mod = imp.new_module(fullname)
+    mod.__file__ = join(pathname, "__init__.py")
+    mod.__path__ = [pathname]
+    mod.__ready__ = False
+
+    def ready():
+        del _provisioning[plugin_name]
+        try:
+            claim_venv(plugin_name, venv_name)
+            _load_plugin(fullname, found, venv_name)
+        except Exception:
+            snake._report_exception("Error loading plugin %s:" % plugin_name)
+            return
+        mod.__loader__ = loader
+        mod.__package__ = fullname
+        mod.__ready__ = True
+        _show_provisioning(plugin_name)
+
+    def failed(error):
+        del _provisioning[plugin_name]
+        try:
+            raise error
+        except Exception:
+            snake._report_exception("Couldn't create a virtualenv for plugin \
+%s:" % plugin_name)
+
+    _provisioning[plugin_name] = _provision_in_background(venv_name, reqs,
+            ready, failed)
+    _show_provisioning()
+    return mod
+
+def _provision_in_background(venv_name, reqs, ready, failed):
+    """ provisions the virtualenv venv_name from reqs, then calls ready(), or
+    failed(error) if it couldn't.  plugins that need the same virtualenv share
+    one task.  returns the task """
+    if venv_name in _venv_tasks:
+        task, waiting = _venv_tasks[venv_name]
+        waiting.append((ready, failed))
+        return task
+
+    def done(venv_dir):
+        for ready, _ in _venv_tasks.pop(venv_name)[1]:
+            ready()
+
+    def error(e):
+        for _, failed in _venv_tasks.pop(venv_name)[1]:
+            failed(e)
+
+    task = snake.run_async(provision_venv, venv_name, reqs, callback=done,
+            error_callback=error)
+    _venv_tasks[venv_name] = (task, [(ready, failed)])
+    return task
+
 
 class SnakePluginHook(object):
     """ allows us to import plugins while installing their dependencies like so:
@@ -127,50 +364,51 @@ class SnakePluginHook(object):
             # it's a snake plugin
             elif len(self.parts) == 3:
                 plugin_name = self.parts[-1]
-                h, pathname, desc = imp.find_module(self.plugin_module,
+                found = imp.find_module(self.plugin_module,
                         self.plugin_paths)
 
-                is_package = desc[-1] == imp.PKG_DIRECTORY
+                is_package = found[2][-1] == imp.PKG_DIRECTORY
 
                 # the module is a package, therefore there might be a
                 # requirements file, and if there's a reqs file, there's a
                 # virtualenv that we need to activate
                 if is_package:
-                    venv_name = venv_name_from_module_name(plugin_name)
-                    reqs = join(pathname, "requirements.txt")
-
-                    needs_venv = not venv_exists(venv_name) and exists(reqs)
-                    can_make_venv = virtualenv is not None and pip is not None
-
-                    # no virtualenv for this plugin?  but we have a requirements
-                    # file?  create one and install all of the requirements
-                    if needs_venv:
-                        if can_make_venv:
-                            print("Creating virtual environment %s for Snake \
-plugin %s..." % (venv_name, plugin_name))
-                            venv_dir = new_venv(venv_name)
-                            print("Installing requirements for plugin %s..." %
-                                    plugin_name)
-                            pip_install(reqs, find_site_packages(venv_dir))
-                        else:
-                            raise Exception("Plugin %s requires a virtualenv. \
+                    reqs = join(found[1], "requirements.txt")
+                    venv_name = None
+                    needs_venv = False
+                    if exists(reqs):
+                        requirements = read_requirements(reqs)
+                        venv_name = venv_name_for_requirements(requirements)
+                        needs_venv = not venv_is_current(venv_name,
+                                requirements)
+
+                    can_make_venv = needs_venv and \
+                            _import_optional("virtualenv") is not None and \
+                            _import_optional("pip") is not None
+
+                    if needs_venv and not can_make_venv:
+                        raise Exception("Plugin %s requires a virtualenv. \
 Please install virtualenv and pip so that one can be created." % plugin_name)
 
-                    # we must have had requirements, because we've created a
-                    # virtualenv.  go ahead and evaluate our module inside our new
-                    # venv
-                    if venv_exists(venv_name):
-                        with in_virtualenv(venv_name):
-                            mod = imp.load_module(fullname, h, pathname, desc)
-                            mod.__virtualenv__ = venv_name
-
+                    # no virtualenv for this plugin's requirements?  create
+                    # one and install all of the requirements, then evaluate
+                    # our module inside our new venv
+                    if needs_venv and _can_provision_in_background():
+                        mod = _load_when_provisioned(self, fullname,
+                                plugin_name, venv_name, reqs, found)
                     else:
-                        mod = imp.load_module(fullname, h, pathname, desc)
+                        if needs_venv:
+                            print("Creating virtual environment %s for Snake \
+plugin %s..." % (venv_name, plugin_name))
+                            provision_venv(venv_name, reqs)
+                        if venv_name is not None:
+                            claim_venv(plugin_name, venv_name)
+                        mod = _load_plugin(fullname, found, venv_name)
 
                 # we're not a package, there is no virtualenv, so load the
                 # module as regular
                 else:
-                    mod = imp.load_module(fullname, h, pathname, desc)
+                    mod = _load_plugin(fullname, found)
 
                 mod.__loader__ = self
                 mod.__package__ = fullname
@@ -180,7 +418,8 @@ Please install virtualenv and pip so that one can be created." % plugin_name)
 
 
 _snake_plugin_paths = [BUNDLE_DIR]
-sys.meta_path.insert(0, SnakePluginHook(_snake_plugin_paths))
+with snake._startup_phase("install plugin hook"):
+    sys.meta_path.insert(0, SnakePluginHook(_snake_plugin_paths))
 
 
 
@@ -189,6 +428,7 @@ def in_virtualenv(venv_name):
     """ activates a virtualenv for the context of the with-block """
     old_path = os.environ["PATH"]
     old_sys_path = sys.path[:]
+    old_prefix = sys.prefix
 
     activate_this = join(VENV_BASE_DIR, venv_name, "bin/activate_this.py")
     execfile(activate_this, dict(__file__=activate_this))
@@ -197,19 +437,179 @@ def in_virtualenv(venv_name):
         yield
     finally:
         os.environ["PATH"] = old_path
-        sys.prefix = sys.real_prefix
+        sys.prefix = old_prefix
         sys.path[:] = old_sys_path
 
 
 def import_source(name, path):
-    desc = (".py", "U", imp.PY_SOURCE)
+    # universal newlines are the default on python 3, which no longer accepts
+    # the "U" mode
+    desc = (".py", "r" if IS_PY3 else "U", imp.PY_SOURCE)
     h = open(path, desc[1])
     module = imp.load_module(name, h, path, desc)
     return module
 
 
+# with SNAKE_CACHE_VIMRC=1, the commands ~/.vimrc.py sends to vim are saved as a
+# vim script the first time it runs.  on later startups, as long as the vimrc,
+# the modules it imports and snake itself haven't changed, that script is
+# sourced instead, in one go, and the vimrc is only imported the first time vim
+# calls one of its functions.  only use this if your vimrc.py sets vim up the
+# same way every time, regardless of things like the file being opened
+cache_vimrc = bool(int(os.environ.get("SNAKE_CACHE_VIMRC", "0")))
+CACHE_DIR = join(expanduser(os.environ.get("XDG_CACHE_HOME", "~/.cache")),
+        "snake")
+SNAPSHOT_FILE = join(CACHE_DIR, "vimrc.vim")
+SNAPSHOT_MANIFEST = join(CACHE_DIR, "vimrc.json")
+# wheels downloaded for plugins' requirements, so plugins that need the same
+# packages can install them without going to the index again
+WHEEL_DIR = join(CACHE_DIR, "wheels")
+
+# the path of a vimrc.py that was replayed from its snapshot, and hasn't been
+# imported yet
+_deferred_vimrc = None
+
+
+def _source_path(module):
+    """ the .py file a module was loaded from, or None """
+    path = getattr(module, "__file__", None)
+    if not path:
+        return None
+    if path.endswith((".pyc", ".pyo")):
+        path = path[:-1]
+    if not exists(path):
+        return None
+    return abspath(path)
+
+def _fingerprint(path):
+    """ [mtime, size, sha1] of a file """
+    import hashlib
+    st = os.stat(path)
+    with open(path, "rb") as h:
+        digest = hashlib.sha1(h.read()).hexdigest()
+    return [st.st_mtime, st.st_size, digest]
+
+def _vim_version():
+    """ the version of vim, down to the patch where vim knows it.  snapshots
+    depend on it, because what snake sends vim depends on what vim supports """
+    return int(snake._eval("exists('v:versionlong') ? v:versionlong : \
+v:version"))
+
+def _snapshot_is_fresh(manifest, path):
+    """ whether the snapshot described by manifest is still good for the vimrc
+    at path.  files are only hashed if their mtime or size changed """
+    if manifest.get("vimrc") != path or \
+            manifest.get("python") != list(sys.version_info[:3]) or \
+            manifest.get("vim") != _vim_version():
+        return False
+    for file_path, (mtime, size, digest) in manifest["files"].items():
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        if st.st_size != size:
+            return False
+        if st.st_mtime != mtime and _fingerprint(file_path)[2] != digest:
+            return False
+    return True
+
+def _snapshot_line(cmd):
+    """ a command, as a line of the snapshot script.  commands that wouldn't
+    survive being a line on their own, like ones with newlines, or that vim
+    would take as a line continuation, are run through :execute """
+    if "\n" in cmd or "\r" in cmd or cmd.lstrip().startswith(("\\", '"')):
+        return "execute " + snake._vim_string(cmd)
+    return cmd
+
+def _write_snapshot(path, commands, modules):
+    """ saves the commands that the vimrc at path sent to vim, keyed on it, the
+    modules it imported, and snake """
+    import json
+    files = set([path, _source_path(snake), _source_path(sys.modules[__name__]),
+        join(dirname(dirname(abspath(snake.__file__))), "prelude.vim")])
+    files.update(p for p in (_source_path(m) for m in modules) if p)
+    files.discard(None)
+    manifest = {
+        "vimrc": path,
+        "python": list(sys.version_info[:3]),
+        "vim": _vim_version(),
+        "files": dict((f, _fingerprint(f)) for f in files if exists(f)),
+    }
+
+    if not exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    # written to the side and moved into place, so a vim starting at the same
+    # time never sees half of one
+    for dest, content in ((SNAPSHOT_FILE, "\n".join(_snapshot_line(c) for c in
+            commands) + "\n"), (SNAPSHOT_MANIFEST, json.dumps(manifest))):
+        tmp = "%s.%d" % (dest, os.getpid())
+        with open(tmp, "w") as h:
+            h.write(content)
+        os.rename(tmp, dest)
+
+def _replay_snapshot(path):
+    """ sources the snapshot of the vimrc at path, if there's a fresh one.
+    returns whether it did """
+    global _deferred_vimrc
+    import json
+    try:
+        with open(SNAPSHOT_MANIFEST) as h:
+            manifest = json.load(h)
+    except (IOError, OSError, ValueError):
+        return False
+    if not exists(SNAPSHOT_FILE) or not _snapshot_is_fresh(manifest, path):
+        return False
+
+    try:
+        snake.command("source %s" % snake.escape_spaces(SNAPSHOT_FILE))
+    except Exception:
+        # a broken snapshot is no worse than not having one
+        os.remove(SNAPSHOT_MANIFEST)
+        return False
+    _deferred_vimrc = path
+    return True
+
+def _load_and_snapshot(path):
+    """ imports the vimrc at path, saving a snapshot of what it did to vim if
+    it can be replayed.  it can't if the vimrc started something that has to
+    be running, like a timer or background task """
+    before = set(sys.modules)
+    with snake._logging_commands() as commands:
+        import_source("vimrc", path)
+        snake._flush_batch()
+
+    if snake._timers or snake._async_tasks or snake._scheduled_tasks:
+        return
+    modules = [sys.modules[name] for name in set(sys.modules) - before
+            if sys.modules.get(name) is not None]
+    try:
+        _write_snapshot(path, commands, modules)
+    except (IOError, OSError):
+        pass
+
+def load_deferred_vimrc():
+    """ imports the vimrc.py that was replayed from its snapshot, so its
+    functions exist.  vim is already set up, so the commands it sends are
+    skipped.  returns whether there was a vimrc to import """
+    global _deferred_vimrc
+    path, _deferred_vimrc = _deferred_vimrc, None
+    if path is None:
+        return False
+    with snake._skipping_commands():
+        import_source("vimrc", path)
+    return True
+
+
 load_vimrc = bool(int(os.environ.get("LOAD_VIMPY", "1")))
 
 vimrc_path = expanduser("~/.vimrc.py")
 if exists(vimrc_path) and load_vimrc:
-    import_source("vimrc", vimrc_path)
+    if not cache_vimrc:
+        with snake._startup_phase("load ~/.vimrc.py"):
+            import_source("vimrc", vimrc_path)
+    else:
+        with snake._startup_phase("replay ~/.vimrc.py snapshot"):
+            replayed = _replay_snapshot(vimrc_path)
+        if not replayed:
+            with snake._startup_phase("load and snapshot ~/.vimrc.py"):
+                _load_and_snapshot(vimrc_path)
@@ -7,6 +7,17 @@ import sh
 import json
 import codecs
 import re
+import atexit
+import shutil
+import socket
+import threading
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 THIS_DIR = dirname(abspath(__file__))
 SNAKE_DIR = join(THIS_DIR, "plugin")
@@ -19,6 +30,11 @@ version_str = sh.vim(version=True).strip()
 VIM_IS_PY3 = "+python3" in version_str
 PYTHON_CMD = "python3" if VIM_IS_PY3 else "python"
 
+# how many vims to keep warm for running tests.  0 starts a fresh vim for every
+# test instead
+TEST_WORKERS = int(os.environ.get("SNAKE_TEST_WORKERS", cpu_count()))
+WORKER_START_TIMEOUT = 60
+
 
 def create_tmp_file(code, prefix="tmp", delete=True):
     """ creates a temporary test file that lives on disk, on which we can run
@@ -35,7 +51,7 @@ def create_tmp_file(code, prefix="tmp", delete=True):
     return py
 
 
-VIMRC = create_tmp_file(r"""
+VIMRC_SOURCE = r"""
 let mapleader = ","
 set clipboard=unnamed
 set t_vb=ERROR
@@ -45,10 +61,176 @@ import sys
 from os.path import expanduser
 sys.path.insert(0, "{SNAKE_DIR}")
 import snake
-""".format(PYTHON_CMD=PYTHON_CMD, SNAKE_DIR=SNAKE_DIR))
+""".format(PYTHON_CMD=PYTHON_CMD, SNAKE_DIR=SNAKE_DIR)
+VIMRC = create_tmp_file(VIMRC_SOURCE)
+
+
+# the python side of a pooled vim worker, appended to our vimrc.  a worker
+# starts up like any other test vim, then waits on a unix socket for its test:
+# the script to run, the file to edit, and the commands to run afterwards
+WORKER_VIMRC = create_tmp_file(VIMRC_SOURCE + r"""
+import json
+import socket
+import traceback
+import __main__
+import vim
+
+def _snake_test_serve(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    h = conn.makefile("rwb")
+    line = h.readline()
+    if not line:
+        # the pool is shutting down, and never gave us a test
+        vim.command("qa!")
+        return
+
+    job = json.loads(line.decode("utf8"))
+    vim.command("execute 'silent edit! ' . fnameescape('%s')" %
+            job["input"].replace("'", "''"))
+
+    sent = []
+    ns = __main__.__dict__
+    exec("import json\nfrom snake import *", ns)
+    ns["send"] = sent.append
+    error = None
+    try:
+        exec(compile(job["script"], "<test script>", "exec"), ns)
+    except Exception:
+        error = traceback.format_exc()
+
+    # like the fifo in run_vim, the last thing sent wins
+    response = {"output": sent[-1] if sent else None, "error": error}
+    h.write(json.dumps(response).encode("utf8") + b"\n")
+    h.flush()
+    conn.close()
+
+    for command in job["commands"]:
+        vim.command(command)
+EOF
+""")
+
+
+class VimPool(object):
+    """ keeps warm headless vims ready to run tests.  starting vim, sourcing
+    our vimrc and prelude.vim and importing snake is most of the time a test
+    takes, so that happens ahead of time, in the background, for as many vims
+    as we have workers.  tests are handed to a waiting vim over a unix socket,
+    and its result comes back the same way.
+
+    vim never reuses buffer numbers, and lots of our tests depend on the input
+    file being buffer 1, so each vim only runs one test, which also means
+    there's no state to reset between tests.  a replacement is started as soon
+    as a vim is taken """
+
+    def __init__(self, size):
+        self.size = size
+        self.sock_dir = tempfile.mkdtemp(prefix="snake_pool")
+        self.ready = queue.Queue()
+        self.lock = threading.Lock()
+        self.counter = 0
+        # the sockets of vims that are waiting for a test
+        self.waiting = set()
+        for _ in range(size):
+            self._spawn()
+
+    def _spawn(self):
+        with self.lock:
+            self.counter += 1
+            path = join(self.sock_dir, "%d.sock" % self.counter)
+        t = threading.Thread(target=self._start_worker, args=(path,))
+        t.daemon = True
+        t.start()
+
+    def _start_worker(self, path):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        listener.settimeout(WORKER_START_TIMEOUT)
+
+        args = ["-N", "-n", "-i", "NONE", "-u", WORKER_VIMRC.name, "-b", "-c",
+            "%s _snake_test_serve('%s')" % (PYTHON_CMD, path)]
+        env = os.environ.copy()
+        env["LOAD_VIMPY"] = "0"
+        process = None
+        try:
+            process = sh.vim(*args, _tty_in=True, _env=env, _bg=True)
+            conn, _ = listener.accept()
+        except Exception as e:
+            if process is not None:
+                process.kill()
+            self.ready.put(e)
+            return
+        finally:
+            listener.close()
+            os.remove(path)
+
+        with self.lock:
+            self.waiting.add(conn)
+        self.ready.put((process, conn))
+
+    def run(self, script, input_str=None, commands=None):
+        """ runs a test in a waiting vim, with the same arguments and results
+        as run_vim """
+        worker = self.ready.get(timeout=WORKER_START_TIMEOUT)
+        self._spawn()
+        if isinstance(worker, Exception):
+            raise worker
+        process, conn = worker
+
+        if commands is None:
+            commands = ["wqa!"]
+        input_file = create_tmp_file(input_str or "")
+        job = {"script": script, "input": input_file.name,
+                "commands": commands}
+
+        try:
+            h = conn.makefile("rwb")
+            h.write(json.dumps(job).encode("utf8") + b"\n")
+            h.flush()
+            response = json.loads(h.readline().decode("utf8"))
+        finally:
+            conn.close()
+            with self.lock:
+                self.waiting.discard(conn)
+        process.wait()
+
+        if response["error"]:
+            sys.stderr.write(response["error"])
+
+        input_file.seek(0)
+        changed = input_file.read().decode("utf8")
+        return changed, response["output"]
+
+    def close(self):
+        """ tells the vims that are still waiting to quit """
+        with self.lock:
+            waiting, self.waiting = self.waiting, set()
+        for conn in waiting:
+            conn.close()
+        shutil.rmtree(self.sock_dir, ignore_errors=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """ the shared VimPool, started the first time it's needed.  returns None
+    if pooling is turned off with SNAKE_TEST_WORKERS=0, or can't work here """
+    global _pool
+    with _pool_lock:
+        if _pool is None and TEST_WORKERS and hasattr(socket, "AF_UNIX"):
+            _pool = VimPool(TEST_WORKERS)
+            atexit.register(_pool.close)
+    return _pool
 
 
 def run_vim(script, input_str=None, vimrc=VIMRC.name, commands=None):
+    # tests that use our usual vimrc can run in one of the pool's vims
+    pool = get_pool() if vimrc == VIMRC.name else None
+    if pool is not None:
+        return pool.run(script, input_str, commands)
+
     # we can't use a real fifo because it will block on opening, because one
     # side will wait for the other side to open before unblocking
     fifo = tempfile.NamedTemporaryFile(delete=True, mode="w+b")
@@ -152,6 +334,18 @@ send(over)
         self.assertEqual(output, "over")
 
 
+    def test_get_word_iskeyword(self):
+        script = r"""
+set_register("0", "zero")
+set_option("iskeyword", "@,48-57,_,-")
+keys("^w")
+send([get_word(), get_register("0")])
+"""
+
+        changed, output = run_vim(script, "foo some-thing bar")
+        self.assertEqual(output, ["some-thing", "zero"])
+
+
     def test_delete_word(self):
         script = r"""
 keys("^5w")
@@ -170,6 +364,25 @@ set_buffer_contents(buf, "new stuff")
         changed, output = run_vim(script, self.sample_text)
         self.assertEqual(changed, "new stuff")
 
+    def test_set_buffer_lines_diff(self):
+        script = r"""
+buf = get_current_buffer()
+lines = get_buffer_lines(buf)
+lines[1] = "changed"
+del lines[5]
+lines.append("added")
+touched = set_buffer_lines(buf, lines, diff=True)
+send([touched, set_buffer_lines(buf, lines, diff=True)])
+"""
+
+        changed, output = run_vim(script, self.sample_block)
+        expected = self.sample_block.split("\n")
+        expected[1] = "changed"
+        del expected[5]
+        expected.append("added")
+        self.assertEqual(changed, "\n".join(expected))
+        self.assertEqual(output, [3, 0])
+
     def test_abbrev(self):
         script = r"""
 abbrev("abc", "123")
@@ -193,6 +406,27 @@ keys("iabc\<C-]> abc\<C-]>")
         changed, output = run_vim(script)
         self.assertEqual(changed, "1 2\n")
 
+    def test_abbrev_fn_expr(self):
+        script = r"""
+abbrev("abc", lambda: "expanded", expr=True)
+keys("iabc\<C-]>")
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(changed, "expanded\n")
+
+    def test_abbrev_fn_edits_buffer(self):
+        script = r"""
+def footer():
+    buf = get_current_buffer()
+    set_buffer_lines(buf, get_buffer_lines(buf) + ["# footer"])
+    return "done"
+
+abbrev("abc", footer)
+keys("iabc\<C-]>")
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(changed, "done\n# footer\n")
+
 
     def test_num_lines(self):
         script = r"""
@@ -213,6 +447,152 @@ send([test1, test2])
         self.assertFalse(output[0])
         self.assertTrue(output[1])
 
+    def test_state(self):
+        script = r"""
+keys("Gll")
+s = state()
+with preserve_cursor(s):
+    keys("gg")
+send([s.mode, s.cursor, s.num_lines, s.buffer, s.window,
+    is_last_line(s), get_cursor_position()])
+"""
+        _, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, ["n", [8, 3], 8, 1, 1, True, [8, 3]])
+
+    def test_version_constants(self):
+        script = r"""
+import snake
+send([snake.VERSION == VERSION == int(vim.eval("v:version")),
+    PYEVAL in ("pyeval", "Pyeval")])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, [True, True])
+
+    def test_startup_profile(self):
+        script = r"""
+import snake
+snake._startup_profile = []
+key_map("a", lambda: None)
+key_map("b")(lambda: None)
+abbrev("teh", "the")
+snake._finish_startup_profile()
+key_map("c", lambda: None)
+send([name for name, ms in startup_profile()])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, ["key_map a", "key_map b", "abbrev teh"])
+
+    def test_round_trips(self):
+        script = r"""
+keys("gg^w")
+with expect_round_trips(max=1):
+    get_word()
+with expect_round_trips(max=1):
+    state()
+with expect_round_trips(max=1):
+    get_num_buffers()
+with expect_round_trips(max=2):
+    search("line")
+
+try:
+    with expect_round_trips(max=1):
+        get_word()
+        get_word()
+except AssertionError:
+    over = True
+else:
+    over = False
+
+with count_round_trips() as trips:
+    get_word()
+    with batch():
+        set_option("tw", 80)
+        set_option("sw", 4)
+send([over, trips.total, sorted(trips.by_function.items())])
+"""
+        _, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, [True, 2, [["batch", 1], ["get_word", 1]]])
+
+    def test_round_trips_batched(self):
+        script = r"""
+buf = get_current_buffer()
+# the first call finds out whether vim has getbufinfo()
+get_buffers()
+
+with expect_round_trips(max=1):
+    state()
+with expect_round_trips(max=1):
+    get_buffers()
+with expect_round_trips(max=1):
+    get_buffer_info()
+with expect_round_trips(max=1):
+    with batch():
+        for i in range(50):
+            let("batched_%d" % i, str(i))
+        multi_command("let g:x = 1", "let g:y = 2")
+
+keys("ggvj\<esc>")
+with expect_round_trips(max=1):
+    get_visual_selection()
+
+enable_buffer_cache()
+get_buffer_lines(buf)
+# only the changedtick is fetched, the lines come from the cache
+with expect_round_trips(max=1):
+    get_buffer_lines(buf)
+with expect_round_trips(max=1):
+    get_buffer_contents(buf)
+with expect_round_trips(max=1):
+    get_buffer_contents(buf)
+disable_buffer_cache()
+send([get("batched_49"), get("y")])
+"""
+        _, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, ["49", "2"])
+
+    def test_flight_recorder(self):
+        script = r"""
+import tempfile
+keys("gg^w")
+start_recording(size=2)
+set_option("tw", 80)
+get_word()
+debug("it's done")
+recording = stop_recording()
+
+path = tempfile.mktemp(suffix=".vim")
+export_recording(path, recording)
+with open(path) as h:
+    replay = [line.strip() for line in h if not line.startswith('"')]
+send([[(r.kind, r.function) for r in recording], replay[1].split("(")[0],
+    replay[2]])
+"""
+        _, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, [
+            [["eval", "get_word"], ["command", "debug"]],
+            "silent! let g:_snake_replay = eval",
+            "silent! execute 'echo ''it''''s done'''",
+        ])
+
+    def test_flight_recorder_buffer_writes(self):
+        script = r"""
+import tempfile
+buf = get_current_buffer()
+start_recording()
+set_buffer_contents(buf, "one\ntwo")
+set_buffer_contents(buf, "one\n2\ntwo", diff=True)
+recording = stop_recording()
+set_buffer_contents(buf, "")
+
+path = tempfile.mktemp(suffix=".vim")
+export_recording(path, recording)
+command("source " + path)
+send([[r.function for r in recording if r.kind == "buffer"],
+    get_buffer_contents(buf)])
+"""
+        _, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, [["set_buffer_contents"] * 2, "one\n2\ntwo"])
+
     def test_preserve_cursor(self):
         script = r"""
 keys("gg^w")
@@ -307,6 +687,121 @@ send([count1, count2, count3])
         self.assertEqual(output, [0, 0, 1])
 
 
+    def test_autocmd_context(self):
+        script = r"""
+events = []
+@on_autocmd("User", "Snake'Test")
+def hooks(ctx):
+    events.append([ctx.event, ctx.bufnr, ctx.match, ctx.filetype])
+
+set_option("filetype", "text")
+command("doautocmd User Snake'Test")
+send(events + [get_current_buffer()])
+"""
+        _, output = run_vim(script, self.sample_text)
+        buf = output.pop()
+        self.assertEqual(output, [["User", buf, "Snake'Test", "text"]])
+
+
+    def test_subscribe(self):
+        script = r"""
+calls = []
+def first(ctx):
+    calls.append("first")
+def broken(ctx):
+    raise Exception("oops")
+def last(ctx):
+    calls.append("last")
+
+for fn in (first, broken, last):
+    subscribe("User", "SnakeTest", fn)
+command("doautocmd User SnakeTest")
+unsubscribe("User", "SnakeTest", subscribe("User", "SnakeTest", first))
+command("doautocmd User SnakeTest")
+send(calls)
+"""
+        _, output = run_vim(script, self.sample_text)
+        self.assertEqual(output, ["first", "last", "last"])
+
+    def test_subscribe_failing_command(self):
+        script = r"""
+def first(ctx):
+    let("first", "1")
+def bad(ctx):
+    command("let g:bad = undefined_variable")
+def last(ctx):
+    let("last", "1")
+
+for fn in (first, bad, last):
+    subscribe("User", "SnakeTest", fn)
+command("doautocmd User SnakeTest")
+send([get("first"), get("last"), "E121" in command("messages", capture=True)])
+"""
+        _, output = run_vim(script, self.sample_text)
+        self.assertEqual(output, ["1", "1", True])
+
+    def test_autocmd_debounce(self):
+        script = r"""
+import snake, time
+calls = []
+@on_autocmd("User", "SnakeTest", debounce=10)
+def changed(ctx):
+    calls.append(ctx.event_count)
+
+for i in range(3):
+    command("doautocmd User SnakeTest")
+count1 = len(calls)
+
+# fire the pending timer ourselves, since vim's won't get a chance to
+time.sleep(0.02)
+for timer in list(snake._timers):
+    snake._on_timer(timer)
+
+send([count1, calls])
+"""
+        _, output = run_vim(script, self.sample_text)
+        self.assertEqual(output, [0, [3]])
+
+    def test_autocmd_debounce_other_buffer(self):
+        script = r"""
+import snake, time
+calls = []
+@on_autocmd("User", "SnakeTest", debounce=10)
+def changed(ctx):
+    calls.append([ctx.bufnr, get_current_buffer()])
+    let("debounced", "1", scope=NS_BUFFER)
+
+first = get_current_buffer()
+command("doautocmd User SnakeTest")
+# the user moves on to another buffer before the handler runs
+other = new_buffer("other")
+set_buffer(other)
+
+# fire the pending timer ourselves, since vim's won't get a chance to
+time.sleep(0.02)
+for timer in list(snake._timers):
+    snake._on_timer(timer)
+
+send([calls == [[first, first]], get_current_buffer() == other,
+    vim.eval("getbufvar(%d, 'debounced')" % first),
+    vim.eval("getbufvar(%d, 'debounced')" % other)])
+"""
+        _, output = run_vim(script, self.sample_text)
+        self.assertEqual(output, [True, True, "1", ""])
+
+
+    def test_command_capture(self):
+        script = r"""
+set_register("a", "untouched")
+out = command("echo 'hello'", capture=True)
+lines = list(iter_command_output("echo 'one' | echo 'two' | echo 'three'",
+    chunk_size=2))
+send([out.strip(), lines, get_register("a")])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, ["hello", ["one", "two", "three"],
+            "untouched"])
+
     def test_current_file(self):
         script = r"""
 send(get_current_file())
@@ -375,6 +870,60 @@ send([get_visual_selection(), get_mode()])
         self.assertEqual(output, "il Mary, full of grace.\nThe Lord is with \
 thee.\nBles")
 
+    def test_get_visual_selection_eol(self):
+        script = r"""
+keys("jwv$")
+keys("\<esc>")
+selection = get_visual_selection()
+keys("gvy")
+send([selection, get_register("0")])
+replace_visual_selection("is here. ")
+"""
+        changed, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, ["Lord is with thee.\n"] * 2)
+        self.assertEqual(changed.split("\n")[1], "The is here. Blessed art \
+thou amongst women,")
+
+    def test_get_visual_selection_linewise(self):
+        script = r"""
+keys("jVj")
+keys("\<esc>")
+send(get_visual_selection())
+"""
+        changed, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, "The Lord is with thee.\nBlessed art thou \
+amongst women,\n")
+
+    def test_get_visual_selection_blockwise(self):
+        script = r"""
+keys("gglll\<C-v>jjl")
+keys("\<esc>")
+send([get_visual_selection(), get_register("0")])
+"""
+        changed, output = run_vim(script, self.sample_block)
+        self.assertEqual(output, ["l \n L\nss", None])
+
+    def test_get_visual_selection_blockwise_eol(self):
+        script = r"""
+keys("gg3l\<C-v>jj$")
+active = get_visual_selection()
+keys("\<esc>")
+after = get_visual_selection()
+keys("gvy")
+send([active, after, get_register('"')])
+"""
+        changed, output = run_vim(script, "a\tbc\n0123456789\nxy")
+        self.assertEqual(output, ["      bc\n23456789\n"] * 3)
+
+    def test_replace_visual_selection_blockwise(self):
+        script = r"""
+keys("gg\<C-v>jl")
+keys("\<esc>")
+replace_visual_selection("ab\ncd")
+"""
+        changed, output = run_vim(script, "1234\n5678")
+        self.assertEqual(changed, "ab34\ncd78")
+
     def test_replace_visual_selection(self):
         script = r"""
 keys("wwvee")
@@ -426,6 +975,89 @@ send(called)
         changed, output = run_vim(script)
         self.assertEqual(output, 4)
 
+    def test_profiler(self):
+        script = r"""
+def slow():
+    get_current_buffer()
+
+enable_profiler()
+key_map("a", slow)
+keys("aa")
+stats = profile_stats()
+buf = profile_report()
+send([len(stats), stats[0]["calls"], stats[0]["vim"] > 0,
+    len(get_buffer_lines(buf))])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, [1, 2, True, 3])
+
+
+    def test_vimrc_snapshot(self):
+        script = r"""
+import snake, tempfile
+from os.path import join
+loader = snake.plugin_loader
+loader.CACHE_DIR = tempfile.mkdtemp()
+loader.SNAPSHOT_FILE = join(loader.CACHE_DIR, "vimrc.vim")
+loader.SNAPSHOT_MANIFEST = join(loader.CACHE_DIR, "vimrc.json")
+
+vimrc = join(loader.CACHE_DIR, "vimrc.py")
+with open(vimrc, "w") as h:
+    h.write("from snake import *\nkey_map('Q', lambda: let('pressed', 1))\n")
+
+loader._load_and_snapshot(vimrc)
+command("nunmap Q")
+snake._mapped_functions.clear()
+
+replayed = loader._replay_snapshot(vimrc)
+keys("Q")
+send([replayed, get("pressed"), loader._deferred_vimrc])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, [True, "1", None])
+
+    def test_plugin_requirements(self):
+        script = r"""
+import snake, tempfile
+from os.path import join
+loader = snake.plugin_loader
+
+reqs = tempfile.mkdtemp()
+with open(join(reqs, "a.txt"), "w") as h:
+    h.write("Flask_Login==0.4  # logins\n\nrequests >= 2.0\n-r common.txt\n")
+with open(join(reqs, "common.txt"), "w") as h:
+    h.write("# shared by both\nsix\n")
+with open(join(reqs, "b.txt"), "w") as h:
+    h.write("six\nflask-login==0.4\nrequests>=2.0\n")
+
+a = loader.read_requirements(join(reqs, "a.txt"))
+b = loader.read_requirements(join(reqs, "b.txt"))
+send([a, loader.venv_name_for_requirements(a) ==
+    loader.venv_name_for_requirements(b),
+    loader.venv_name_for_requirements(a) ==
+    loader.venv_name_for_requirements(a[1:])])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, [["flask-login==0.4", "requests>=2.0", "six"],
+            True, False])
+
+    def test_key_map_cmdline_dispatch(self):
+        script = r"""
+set_dispatch_mode(DISPATCH_CMDLINE)
+called = 0
+def side_effect():
+    global called
+    called += 1
+
+key_map("a", side_effect)
+visual_key_map("b", lambda sel: sel.upper())
+keys("aaWviwb")
+send([called, get_mode()])
+"""
+        changed, output = run_vim(script, self.sample_text)
+        self.assertEqual(output, [2, "n"])
+        self.assertEqual(changed, "The QUICK brown fox jumps over the lazy dog")
+
     def test_visual_key_map(self):
         script = r"""
 def process(stuff):
@@ -441,6 +1073,166 @@ keys("Wviwa")
 
 
 
+    def test_registry(self):
+        script = r"""
+def a(): pass
+def b(): pass
+size1 = registry_info()["size"]
+key_map("x", a)
+key_map("x", b)
+size2 = registry_info()["size"]
+
+n = new_buffer("other")
+set_buffer(n)
+key_map("y", a, local=True)
+size3 = registry_info()["size"]
+set_buffer(1)
+command("bwipeout! %d" % n)
+
+key_map("x", ":echo<CR>")
+send([size2 - size1, size3 - size1, registry_info()["size"] - size1,
+    registry_info()["stale"]])
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(output, [1, 2, 0, []])
+
+
+
+class AsyncTests(VimTests):
+    def test_run_async(self):
+        script = r"""
+import snake
+results = []
+def failed(e):
+    results.append(type(e).__name__)
+
+tasks = [
+    run_async(lambda a, b: a + b, 1, 2, callback=results.append),
+    run_async(lambda: 1 / 0, error_callback=failed),
+    run_async(lambda: "old", callback=results.append, key=1),
+    run_async(lambda: "new", callback=results.append, key=1),
+]
+for task in tasks:
+    try:
+        task.future.result()
+    except Exception:
+        pass
+
+# this is what our vim timer calls on the main thread
+snake._poll_async()
+send([str(r) for r in results])
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(sorted(output), ["3", "ZeroDivisionError", "new"])
+
+    def test_spawn(self):
+        script = r"""
+import snake
+results = []
+def count(n):
+    for i in range(n):
+        yield float(i) / n
+    results.append(n)
+
+def forever():
+    while True:
+        yield
+
+low = spawn(count(3))
+high = spawn(forever(), priority=1, buffer=get_current_buffer(),
+    cancel_on_change=True)
+
+# this is what our vim timer calls
+snake._run_scheduler_slice()
+results.append(low.progress)
+set_buffer_contents(get_current_buffer(), "changed")
+snake._run_scheduler_slice()
+results.append(high.cancelled)
+send(results)
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(output, [None, 3, True])
+
+    def test_spawn_cancel_other(self):
+        script = r"""
+import snake
+events = []
+def victim():
+    try:
+        while True:
+            yield
+    finally:
+        events.append("victim closed")
+
+def killer():
+    victim_task.cancel()
+    yield
+    events.append("killer done")
+
+victim_task = spawn(victim(), on_done=lambda r: events.append("on_done"))
+spawn(killer())
+
+# this is what our vim timer calls
+snake._run_scheduler_slice()
+send([events, victim_task.cancelled, len(get_scheduled_tasks())])
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(output, [["victim closed", "killer done"], True, 0])
+
+    def test_spawn_cancel_self(self):
+        script = r"""
+import snake
+events = []
+def quitter():
+    try:
+        quitter_task.cancel()
+        yield
+        events.append("resumed")
+    finally:
+        events.append("closed")
+
+quitter_task = spawn(quitter(), on_done=lambda r: events.append("on_done"))
+
+# this is what our vim timer calls
+snake._run_scheduler_slice()
+send([events, quitter_task.cancelled, len(get_scheduled_tasks())])
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(output, [["closed"], True, 0])
+
+    def test_background_venv(self):
+        script = r"""
+import snake, os, tempfile
+from os.path import join
+loader = snake.plugin_loader
+
+plugins = tempfile.mkdtemp()
+os.mkdir(join(plugins, "needs_reqs"))
+with open(join(plugins, "needs_reqs", "requirements.txt"), "w") as h:
+    h.write("sh\n")
+with open(join(plugins, "needs_reqs", "__init__.py"), "w") as h:
+    h.write("from snake import *\nkey_map('Q', lambda: let('pressed', 1))\n")
+loader._snake_plugin_paths.append(plugins)
+
+# stand-ins for virtualenv and pip
+loader.VENV_BASE_DIR = tempfile.mkdtemp()
+loader._import_optional = lambda name: True
+loader.provision_venv = lambda name, reqs: join(loader.VENV_BASE_DIR, name)
+
+from snake.plugins import needs_reqs
+results = [needs_reqs.__ready__]
+loader._provisioning["needs_reqs"].future.result()
+
+# this is what our vim timer calls on the main thread
+snake._poll_async()
+keys("Q")
+results.extend([needs_reqs.__ready__, get("pressed")])
+send(results)
+"""
+        changed, output = run_vim(script)
+        self.assertEqual(output, [False, True, "1"])
+
+
 class OptionsTests(VimTests):
     def test_get_set_value(self):
         script = r"""
@@ -500,6 +1292,67 @@ send({
         self.assertEqual(output["c"], "3")
 
 
+class BatchTests(VimTests):
+    def test_batch(self):
+        script = r"""
+with batch():
+    let("a", "1")
+    set_option("tw", 80)
+    # reads flush the batch early
+    a = get("a")
+    let("b", "2")
+send([a, get("b"), int(get_option("tw"))])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, ["1", "2", 80])
+
+    def test_batch_decorator(self):
+        script = r"""
+@batch()
+def setup():
+    multi_command("let g:x = 1", "let g:y = 'it''s'")
+    let("z", "3")
+
+setup()
+send([get("x"), get("y"), get("z")])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, ["1", "it's", "3"])
+
+    def test_batch_error(self):
+        script = r"""
+error = None
+try:
+    with batch():
+        let("a", "1")
+        command("let g:b = undefined_variable")
+        let("c", "3")
+except vim.error as e:
+    error = "E121" in str(e)
+leftover = vim.eval("len(filter(keys(g:), 'v:val =~# \"^_snake_batch\"'))")
+send([get("a"), get("c"), error, leftover])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, ["1", "3", True, "0"])
+
+    def test_batch_nested_flush(self):
+        script = r"""
+@on_autocmd("User", "SnakeNested")
+def nested(ctx):
+    with batch():
+        let("c", "3")
+        let("d", "4")
+
+with batch():
+    let("a", "1")
+    command("doautocmd User SnakeNested")
+    let("b", "2")
+send([get("a"), get("b"), get("c"), get("d")])
+"""
+        _, output = run_vim(script)
+        self.assertEqual(output, ["1", "2", "3", "4"])
+
+
 class RegisterTests(VimTests):
     def test_get_set_register(self):
         script = r"""
@@ -589,6 +1442,54 @@ send([buf1, num1, buf2, num2, buf3])
         changed, output = run_vim(script, self.sample_text, commands=["qa!"])
         self.assertEqual(output, [1, 1, 1, 2, 2])
 
+    def test_get_buffer_info(self):
+        script = r"""
+n = new_buffer("test1")
+infos = get_buffer_info()
+send([(i.number, i.name, i.current, i.hidden, i.line_count) for i in infos])
+"""
+        changed, output = run_vim(script, self.sample_block, commands=["qa!"])
+        self.assertEqual(output[1], [2, "test1", False, True, 1])
+        self.assertEqual(output[0][0], 1)
+        self.assertTrue(output[0][2])
+        self.assertEqual(output[0][4], 8)
+
+    def test_ranged_buffer_reads(self):
+        script = r"""
+buf = get_current_buffer()
+view = BufferView(buf)
+send([
+    get_buffer_lines(buf, 1, 3),
+    get_buffer_contents(buf, 6),
+    list(iter_buffer_lines(buf, 2, 5, chunk_size=2)),
+    len(list(iter_buffer_lines(buf, chunk_size=3))),
+    len(view),
+    view[-1],
+])
+"""
+        changed, output = run_vim(script, self.sample_block, commands=["qa!"])
+        lines = self.sample_block.split("\n")
+        self.assertEqual(output, [lines[1:3], "\n".join(lines[6:]), lines[2:5],
+            8, 8, "Amen."])
+
+    def test_buffer_cache(self):
+        script = r"""
+buf = get_current_buffer()
+enable_buffer_cache()
+lines1 = get_buffer_lines(buf)
+lines1.append("not in the buffer")
+lines2 = get_buffer_lines(buf)
+contents1 = get_buffer_contents(buf)
+set_buffer_lines(buf, ["changed"])
+contents2 = get_buffer_contents(buf)
+stats = buffer_cache_stats()
+disable_buffer_cache()
+send([len(lines2), contents1 == "\n".join(lines2), contents2, stats["hits"],
+    stats["misses"], buffer_cache_stats()])
+"""
+        changed, output = run_vim(script, self.sample_block, commands=["qa!"])
+        self.assertEqual(output, [8, True, "changed", 1, 3, None])
+
     def test_get_buffers(self):
         script = r"""
 new_buffer("test1")
@@ -628,6 +1529,75 @@ send(get_buffers())
         })
 
 
+class _BufferedResult(unittest.TestResult):
+    """ holds on to what happened in a test running on another thread, so it
+    can be reported to the real result afterwards, in one piece """
+
+    def __init__(self):
+        super(_BufferedResult, self).__init__()
+        self.events = []
+
+    def _record(name):
+        def record(self, *args):
+            self.events.append((name, args))
+        return record
+
+    addSuccess = _record("addSuccess")
+    addFailure = _record("addFailure")
+    addError = _record("addError")
+    addSkip = _record("addSkip")
+    addExpectedFailure = _record("addExpectedFailure")
+    addUnexpectedSuccess = _record("addUnexpectedSuccess")
+    del _record
+
+def _flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in _flatten(test):
+                yield t
+        else:
+            yield test
+
+def run_parallel(suite, verbosity=2):
+    """ runs the tests in suite at the same time, one per pooled vim """
+    runner = unittest.TextTestRunner(verbosity=verbosity)
+    result = runner._makeResult()
+    lock = threading.Lock()
+
+    def run_one(test):
+        buffered = _BufferedResult()
+        test(buffered)
+        with lock:
+            result.startTest(test)
+            for name, args in buffered.events:
+                getattr(result, name)(*args)
+            result.stopTest(test)
+
+    start = time.time()
+    threads = ThreadPool(max(TEST_WORKERS, 1))
+    threads.map(run_one, list(_flatten(suite)))
+    threads.close()
+    elapsed = time.time() - start
+
+    result.printErrors()
+    runner.stream.writeln(result.separator2)
+    runner.stream.writeln("Ran %d tests in %.3fs" % (result.testsRun, elapsed))
+    runner.stream.writeln()
+    runner.stream.writeln("OK" if result.wasSuccessful() else "FAILED")
+    return result
+
+
 if __name__ == "__main__":
     print(sh.vim(version=True))
+    # --parallel runs the tests at the same time, on our pool of vims
+    if "--parallel" in sys.argv:
+        sys.argv.remove("--parallel")
+        names = sys.argv[1:]
+        loader = unittest.TestLoader()
+        if names:
+            suite = loader.loadTestsFromNames(names, sys.modules[__name__])
+        else:
+            suite = loader.loadTestsFromModule(sys.modules[__name__])
+        result = run_parallel(suite)
+        sys.exit(not result.wasSuccessful())
     unittest.main(verbosity=2)